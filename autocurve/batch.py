@@ -0,0 +1,200 @@
+import math
+import multiprocessing
+import os
+import shutil
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from qgis.core import QgsFeatureRequest, QgsGeometry, QgsRectangle, QgsSpatialIndex
+
+from . import settings
+from .kernel import snap_points_from_wkb
+from .utils import Feedback, MiniIndex, Move, apply_moves, has_curves, match_arcs
+
+# Work unit as (tolerance, fids to harmonize, wkb of all features they can snap to)
+Job = Tuple[float, Set[int], List[Tuple[int, bytes]]]
+
+
+def harmonize_layer(
+    source,
+    tolerance: Optional[float] = None,
+    workers=None,
+    tiles=None,
+    feedback: Optional[Feedback] = None,
+) -> Dict[int, QgsGeometry]:
+    """Harmonizes the arcs of all features of a layer (or any feature source).
+
+    The features are split into tiles, each with the neighbours within tolerance of its
+    features, which are matched in a pool of `workers` processes. Returns the new
+    geometries of the features that changed, the source itself is left untouched.
+    """
+
+    request = QgsFeatureRequest().setNoAttributes()
+    geometries = (
+        (feature.id(), feature.geometry()) for feature in source.getFeatures(request)
+    )
+    return harmonize_features(geometries, tolerance, workers, tiles, feedback)
+
+
+def harmonize_features(
+    geometries: Iterable[Tuple[int, QgsGeometry]],
+    tolerance: Optional[float] = None,
+    workers=None,
+    tiles=None,
+    feedback: Optional[Feedback] = None,
+) -> Dict[int, QgsGeometry]:
+    """Harmonizes the arcs of the given (fid, geometry) pairs, see harmonize_layer.
+
+    The geometries are consumed once, so they can be computed on the fly.
+    """
+
+    if tolerance is None:
+        tolerance = settings.distance()
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    # Read all geometries once, only keeping the ones with arcs to harmonize
+    wkbs: Dict[int, bytes] = {}
+    bboxes: Dict[int, QgsRectangle] = {}
+    spatial_index = QgsSpatialIndex()
+    for fid, geometry in geometries:
+        if feedback is not None and feedback.isCanceled():
+            return {}
+        if not has_curves(geometry):
+            continue
+        wkbs[fid] = bytes(geometry.asWkb())
+        bboxes[fid] = geometry.boundingBox()
+        spatial_index.addFeature(fid, bboxes[fid])
+
+    if tiles is None:
+        tiles = math.ceil(math.sqrt(workers * 4))
+    jobs = _make_jobs(wkbs, bboxes, spatial_index, tolerance, tiles)
+
+    moves = None
+    if workers > 1 and len(jobs) > 1:
+        try:
+            moves = _run_jobs_in_pool(jobs, workers, feedback)
+        except (BrokenProcessPool, OSError):
+            # Workers could not be started, fall back to processing in-process
+            moves = None
+    if moves is None:
+        moves = []
+        for i, job in enumerate(jobs):
+            if feedback is not None:
+                if feedback.isCanceled():
+                    return {}
+                feedback.setProgress(100 * i / len(jobs))
+            moves.extend(_harmonize_tile(job))
+
+    # Moves are sorted when applied, so the result doesn't depend on the tiling
+    geometries = {}
+    for fid in {move[0] for move in moves}:
+        geometries[fid] = QgsGeometry()
+        geometries[fid].fromWkb(wkbs[fid])
+    return apply_moves(geometries, moves)
+
+
+def _make_jobs(
+    wkbs: Dict[int, bytes],
+    bboxes: Dict[int, QgsRectangle],
+    spatial_index: QgsSpatialIndex,
+    tolerance: float,
+    tiles: int,
+) -> List[Job]:
+    """Splits the features in a grid of tiles x tiles by their bounding box center"""
+
+    if not bboxes:
+        return []
+
+    extent = QgsRectangle()
+    extent.setMinimal()
+    for bbox in bboxes.values():
+        extent.combineExtentWith(bbox)
+    tile_width = extent.width() / tiles or 1
+    tile_height = extent.height() / tiles or 1
+
+    targets: Dict[Tuple[int, int], Set[int]] = {}
+    for fid, bbox in bboxes.items():
+        center = bbox.center()
+        i = min(int((center.x() - extent.xMinimum()) // tile_width), tiles - 1)
+        j = min(int((center.y() - extent.yMinimum()) // tile_height), tiles - 1)
+        targets.setdefault((i, j), set()).add(fid)
+
+    jobs = []
+    for tile in sorted(targets):
+        # The tile needs all features its own features could snap to
+        search_extent = QgsRectangle()
+        search_extent.setMinimal()
+        for fid in targets[tile]:
+            search_extent.combineExtentWith(bboxes[fid])
+        search_extent.grow(tolerance)
+        candidates = spatial_index.intersects(search_extent)
+        jobs.append(
+            (tolerance, targets[tile], [(fid, wkbs[fid]) for fid in candidates])
+        )
+    return jobs
+
+
+def _run_jobs_in_pool(
+    jobs: List[Job], workers, feedback: Optional[Feedback] = None
+) -> Optional[List[Move]]:
+    """Runs the jobs in a process pool, returns None if canceled"""
+
+    moves = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=_mp_context()) as pool:
+        futures = [pool.submit(_harmonize_tile, job) for job in jobs]
+        for i, future in enumerate(as_completed(futures)):
+            if feedback is not None:
+                if feedback.isCanceled():
+                    for future in futures:
+                        future.cancel()
+                    return None
+                feedback.setProgress(100 * i / len(jobs))
+            moves.extend(future.result())
+    return moves
+
+
+def _harmonize_tile(job: Job) -> List[Move]:
+    """Matches the arcs of one tile, runs in the worker processes"""
+
+    tolerance, target_fids, candidates = job
+
+    index = MiniIndex(tolerance)
+    snap_points = []
+    for fid, wkb in candidates:
+        # Only the kernel is needed to read the arcs, without rebuilding geometries
+        for snap_point in snap_points_from_wkb(fid, wkb):
+            index.add_snap_point(snap_point)
+            if fid in target_fids:
+                snap_points.append(snap_point)
+
+    # All features of the layer are harmonized, so we prevent two-way snapping
+    # between any of them, not only between the ones of this tile
+    fids = {fid for fid, _ in candidates}
+
+    return match_arcs(snap_points, index, tolerance, fids=fids)
+
+
+def _mp_context():
+    """Returns a multiprocessing context able to start workers from QGIS.
+
+    From QGIS desktop, `sys.executable` is QGIS itself, so the workers are started with
+    the python interpreter of the installation instead.
+    """
+
+    context = multiprocessing.get_context("spawn")
+    context.set_executable(_python_executable())
+    return context
+
+
+def _python_executable():
+    if os.path.basename(sys.executable).lower().startswith("python"):
+        return sys.executable
+    for directory in (os.path.join(sys.exec_prefix, "bin"), sys.exec_prefix):
+        for name in ("python3", "python"):
+            executable = shutil.which(name, path=directory)
+            if executable:
+                return executable
+    return sys.executable
@@ -0,0 +1,234 @@
+"""
+Command line interface running the post-processing on whole files, without QGIS desktop.
+
+    python3 -m autocurve.cli input.gpkg output.gpkg [--layer NAME] [--no-curvify]
+
+Features are read and written in chunks. When harmonizing, chunks are read in spatial
+order, so that they can be matched with their neighbours with bounded memory, and are
+written in that order.
+"""
+
+import argparse
+import itertools
+import os
+import sys
+import time
+from typing import Dict, Iterator, NamedTuple, Optional
+
+from qgis.core import (
+    QgsApplication,
+    QgsCoordinateTransformContext,
+    QgsFeatureSink,
+    QgsGeometry,
+    QgsVectorFileWriter,
+    QgsVectorLayer,
+    QgsWkbTypes,
+)
+
+from . import settings
+from .streaming import DEFAULT_CHUNK_SIZE, DEFAULT_WINDOW_SIZE, Chunk, harmonize_chunks
+from .utils import curvify_geometries
+
+
+class Stats(NamedTuple):
+    """Summary of a run"""
+
+    features: int
+    curvified: int
+    harmonized: int
+    duration: float
+
+    def format(self) -> str:
+        throughput = self.features / self.duration if self.duration else 0
+        return (
+            f"{self.features} features ({self.curvified} curvified, "
+            f"{self.harmonized} harmonized) in {self.duration:.1f} s "
+            f"({throughput:.0f} features/s)"
+        )
+
+
+def open_layer(path: str, layer_name: Optional[str] = None) -> QgsVectorLayer:
+    uri = f"{path}|layername={layer_name}" if layer_name else path
+    layer = QgsVectorLayer(uri, "input", "ogr")
+    if not layer.isValid():
+        raise ValueError(f"Could not open {uri}")
+    return layer
+
+
+def process_file(
+    input_path: str,
+    output_path: str,
+    layer_name: Optional[str] = None,
+    output_layer_name: Optional[str] = None,
+    curvify: bool = True,
+    harmonize: bool = True,
+    tolerances: Optional[settings.Tolerances] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    window_size: int = DEFAULT_WINDOW_SIZE,
+) -> Stats:
+    """Curvifies and/or harmonizes all features of a file into a new file"""
+
+    if not curvify and not harmonize:
+        raise ValueError("Nothing to do, curvify and/or harmonize must be enabled")
+
+    start = time.perf_counter()
+    source = open_layer(input_path, layer_name)
+    if tolerances is None:
+        tolerances = settings.layer_tolerances(source)
+    wkb_type = source.wkbType()
+    if curvify:
+        wkb_type = QgsWkbTypes.curveType(wkb_type)
+
+    def curvify_chunk(geometries: Dict[int, QgsGeometry]) -> Dict[int, QgsGeometry]:
+        return curvify_geometries(geometries, tolerances.distance, tolerances.angle)
+
+    if harmonize:
+        chunks = harmonize_chunks(
+            source,
+            tolerances.distance,
+            chunk_size=chunk_size,
+            window_size=window_size,
+            transform=curvify_chunk if curvify else None,
+        )
+    else:
+        chunks = _curvified_chunks(source, chunk_size, curvify_chunk)
+
+    writer = _create_writer(output_path, output_layer_name, source, wkb_type)
+    features = curvified = harmonized = 0
+    try:
+        for chunk in chunks:
+            if not writer.addFeatures(chunk.features, QgsFeatureSink.FastInsert):
+                raise ValueError(f"Could not write features: {writer.errorMessage()}")
+            features += len(chunk.features)
+            curvified += chunk.transformed
+            harmonized += chunk.harmonized
+    finally:
+        # Flushes and closes the output
+        del writer
+
+    return Stats(
+        features=features,
+        curvified=curvified,
+        harmonized=harmonized,
+        duration=time.perf_counter() - start,
+    )
+
+
+def _curvified_chunks(source, chunk_size: int, curvify_chunk) -> Iterator[Chunk]:
+    """Yields the features of the source in chunks, curvified, in their original order"""
+
+    iterator = iter(source.getFeatures())
+    while True:
+        features = list(itertools.islice(iterator, chunk_size))
+        if not features:
+            return
+        new_geoms = curvify_chunk(
+            {feature.id(): feature.geometry() for feature in features}
+        )
+        for feature in features:
+            if feature.id() in new_geoms:
+                feature.setGeometry(new_geoms[feature.id()])
+        yield Chunk(features, len(new_geoms), 0)
+
+
+def _create_writer(
+    path: str, layer_name: Optional[str], source: QgsVectorLayer, wkb_type
+) -> QgsVectorFileWriter:
+    options = QgsVectorFileWriter.SaveVectorOptions()
+    options.driverName = QgsVectorFileWriter.driverForExtension(
+        os.path.splitext(path)[1].lstrip(".")
+    )
+    if not options.driverName:
+        raise ValueError(f"Unsupported output format: {path}")
+    options.fileEncoding = "UTF-8"
+    if layer_name:
+        options.layerName = layer_name
+
+    writer = QgsVectorFileWriter.create(
+        path,
+        source.fields(),
+        wkb_type,
+        source.crs(),
+        QgsCoordinateTransformContext(),
+        options,
+    )
+    if writer.hasError() != QgsVectorFileWriter.NoError:
+        raise ValueError(f"Could not create {path}: {writer.errorMessage()}")
+    return writer
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python3 -m autocurve.cli",
+        description="Converts segments to curves and harmonizes arcs of a whole file.",
+    )
+    parser.add_argument("input", help="input file (GeoPackage, Shapefile, ...)")
+    parser.add_argument(
+        "output", help="output file, its format is guessed from its extension"
+    )
+    parser.add_argument("--layer", help="layer of the input to process")
+    parser.add_argument("--output-layer", help="name of the layer in the output")
+    parser.add_argument(
+        "--no-curvify", action="store_true", help="don't convert segments to curves"
+    )
+    parser.add_argument(
+        "--no-harmonize", action="store_true", help="don't harmonize arcs"
+    )
+    parser.add_argument(
+        "--distance", type=float, help="distance tolerance (default from QGIS settings)"
+    )
+    parser.add_argument(
+        "--angle", type=float, help="angle tolerance (default from QGIS settings)"
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=DEFAULT_CHUNK_SIZE,
+        help="number of features read and written at once",
+    )
+    parser.add_argument(
+        "--window-size",
+        type=int,
+        default=DEFAULT_WINDOW_SIZE,
+        help="number of features whose arcs are kept in memory when harmonizing",
+    )
+    args = parser.parse_args(argv)
+    if args.no_curvify and args.no_harmonize:
+        parser.error("--no-curvify and --no-harmonize leave nothing to do")
+    if args.distance is not None and args.distance <= 0:
+        # Arcs are indexed in cells of the tolerance size
+        parser.error("--distance must be positive")
+
+    app = QgsApplication([], False)
+    app.initQgis()
+    try:
+        tolerances = None
+        if args.distance is not None or args.angle is not None:
+            distance, angle = args.distance, args.angle
+            tolerances = settings.Tolerances(
+                distance=settings.distance() if distance is None else distance,
+                angle=settings.angle() if angle is None else angle,
+            )
+        stats = process_file(
+            args.input,
+            args.output,
+            layer_name=args.layer,
+            output_layer_name=args.output_layer,
+            curvify=not args.no_curvify,
+            harmonize=not args.no_harmonize,
+            tolerances=tolerances,
+            chunk_size=args.chunk_size,
+            window_size=args.window_size,
+        )
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    finally:
+        app.exitQgis()
+
+    print(stats.format())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
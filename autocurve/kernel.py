@@ -0,0 +1,434 @@
+"""
+Geometry kernel of the plugin: arc extraction, circle fitting, matching and indexing.
+
+It works on plain coordinates and WKB, without importing QGIS, so that the hot path can
+be unit tested and profiled in a plain python process. QGIS adapters are in utils.
+"""
+
+import math
+import struct
+from collections import defaultdict
+from functools import lru_cache
+from typing import Collection, Dict, Iterable, List, Optional, Sequence, Tuple
+
+Point = Tuple[float, float]
+
+# Vertex move as (fid, vertex_nr, neighbour fid, x, y, z, m)
+Move = Tuple[int, int, int, float, float, float, float]
+
+# Number of circles kept in memory, whose arcs are read again without having moved
+CIRCLE_CACHE_SIZE = 50000
+
+# WKB geometry types
+_POINT = 1
+_LINESTRING = 2
+_POLYGON = 3
+_MULTIPOINT = 4
+_MULTILINESTRING = 5
+_MULTIPOLYGON = 6
+_GEOMETRYCOLLECTION = 7
+_CIRCULARSTRING = 8
+_COMPOUNDCURVE = 9
+_CURVEPOLYGON = 10
+_MULTICURVE = 11
+_MULTISURFACE = 12
+
+# EWKB flags
+_EWKB_Z = 0x80000000
+_EWKB_M = 0x40000000
+_EWKB_SRID = 0x20000000
+
+# Same as qgsDoubleNear's default epsilon
+_EPSILON = 4 * 2.220446049250313e-16
+
+
+def _almost_equal(p1: Point, p2: Point, tolerance: float):
+    """Test point equality with tolerance"""
+    dx = p1[0] - p2[0]
+    dy = p1[1] - p2[1]
+    return dx * dx + dy * dy <= tolerance * tolerance
+
+
+def circle_center_radius(p1: Point, p2: Point, p3: Point) -> Tuple[float, Point]:
+    """Returns the radius and center of the circle through the three points.
+
+    Follows QgsGeometryUtils.circleCenterRadius: if the first and last points are the
+    same, the circle is the one having the first two points as diameter, and if the
+    points are collinear, the radius is -1 (with a (0, 0) center).
+    """
+
+    x1, y1 = p1[0], p1[1]
+    if abs(x1 - p3[0]) <= _EPSILON and abs(y1 - p3[1]) <= _EPSILON:
+        center_x = (x1 + p2[0]) / 2
+        center_y = (y1 + p2[1]) / 2
+        return math.hypot(center_x - x1, center_y - y1), (center_x, center_y)
+
+    dx21 = p2[0] - x1
+    dy21 = p2[1] - y1
+    dx31 = p3[0] - x1
+    dy31 = p3[1] - y1
+    h21 = dx21 * dx21 + dy21 * dy21
+    h31 = dx31 * dx31 + dy31 * dy31
+
+    # Twice the cross product, zero if collinear
+    d = 2 * (dx21 * dy31 - dx31 * dy21)
+    if abs(d) <= 1e-11:
+        return -1.0, (0.0, 0.0)
+
+    center_x = x1 + (h21 * dy31 - h31 * dy21) / d
+    center_y = y1 - (h21 * dx31 - h31 * dx21) / d
+    return math.hypot(center_x - x1, center_y - y1), (center_x, center_y)
+
+
+# Arcs of static neighbours are read again each time their feature (or a feature next
+# to them) changes, so their circles are memoized by their points across runs
+cached_circle_center_radius = lru_cache(maxsize=CIRCLE_CACHE_SIZE)(circle_center_radius)
+
+
+class SnapCurvePoint:
+    """Helper class to represents a curve point on which we can snap.
+
+    The coordinates of the arc and of its circle are computed once on creation, so that
+    comparing arcs doesn't need to go back to the geometry. The optional layer id tells
+    apart features of different layers sharing an index.
+    """
+
+    __slots__ = (
+        "fid",
+        "layer_id",
+        "vertex_nr",
+        "start",
+        "mid",
+        "end",
+        "z",
+        "m",
+        "center",
+        "radius",
+    )
+
+    def __init__(
+        self,
+        fid: int,
+        vertex_nr: int,
+        start: Point,
+        mid: Point,
+        end: Point,
+        z: float = math.nan,
+        m: float = math.nan,
+        layer_id: Optional[str] = None,
+    ):
+        self.fid = fid
+        self.layer_id = layer_id
+        self.vertex_nr = vertex_nr
+        self.start = start
+        self.mid = mid
+        self.end = end
+        self.z = z
+        self.m = m
+        self.radius, self.center = cached_circle_center_radius(start, mid, end)
+
+    def __repr__(self):
+        return f"SnapCurvePoint(fid={self.fid}, vertex_nr={self.vertex_nr}, start={self.start}, mid={self.mid}, end={self.end})"
+
+    def snaps_to(self, other: "SnapCurvePoint", tolerance: float):
+        # Dont snap the feature against itself
+        if self.fid == other.fid and self.layer_id == other.layer_id:
+            return False
+
+        # Test if start and end points are equal
+        if not (
+            _almost_equal(self.start, other.start, tolerance)
+            and _almost_equal(self.end, other.end, tolerance)
+        ) and not (
+            _almost_equal(self.start, other.end, tolerance)
+            and _almost_equal(self.end, other.start, tolerance)
+        ):
+            return False
+
+        # Test if circles are equivalent (same center point within tolerance)
+        if not _almost_equal(self.center, other.center, tolerance):
+            return False
+
+        return True
+
+
+def snap_points_from_wkb(
+    fid: int, wkb: bytes, layer_id: Optional[str] = None
+) -> List[SnapCurvePoint]:
+    """Returns the snap points of all arcs of a WKB (ISO or EWKB) geometry.
+
+    Vertex numbers are the ones of QgsGeometry, counting the vertices of all parts and
+    rings in order, with vertices shared by the parts of compound curves counted once.
+    """
+
+    curves: List[Tuple[List[Sequence[float]], Iterable[int]]] = []
+    _read_geometry(memoryview(wkb), 0, curves)
+
+    snap_points = []
+    vertex_nr = 0
+    for points, curve_vertices in curves:
+        for i in curve_vertices:
+            mid = points[i]
+            snap_points.append(
+                SnapCurvePoint(
+                    fid,
+                    vertex_nr + i,
+                    (points[i - 1][0], points[i - 1][1]),
+                    (mid[0], mid[1]),
+                    (points[i + 1][0], points[i + 1][1]),
+                    mid[2],
+                    mid[3],
+                    layer_id,
+                )
+            )
+        vertex_nr += len(points)
+    return snap_points
+
+
+def _read_geometry(wkb: memoryview, offset: int, curves: List) -> int:
+    """Appends the vertices of each curve (and point) of the geometry to `curves`, as
+    (points, indexes of curve vertices), and returns the offset after the geometry"""
+
+    endian = "<" if wkb[offset] == 1 else ">"
+    (wkb_type,) = struct.unpack_from(f"{endian}I", wkb, offset + 1)
+    offset += 5
+
+    has_z = bool(wkb_type & _EWKB_Z)
+    has_m = bool(wkb_type & _EWKB_M)
+    if wkb_type & _EWKB_SRID:
+        offset += 4
+    wkb_type &= 0x0FFFFFFF
+    flavour, geometry_type = divmod(wkb_type, 1000)
+    has_z = has_z or flavour in (1, 3)
+    has_m = has_m or flavour in (2, 3)
+    read_points = _points_reader(endian, has_z, has_m)
+
+    if geometry_type == _POINT:
+        points, offset = read_points(wkb, offset, 1)
+        curves.append((points, ()))
+    elif geometry_type in (_LINESTRING, _CIRCULARSTRING):
+        (count,) = struct.unpack_from(f"{endian}I", wkb, offset)
+        points, offset = read_points(wkb, offset + 4, count)
+        if geometry_type == _CIRCULARSTRING:
+            curves.append((points, range(1, count - 1, 2)))
+        else:
+            curves.append((points, ()))
+    elif geometry_type == _POLYGON:
+        (rings,) = struct.unpack_from(f"{endian}I", wkb, offset)
+        offset += 4
+        for _ in range(rings):
+            (count,) = struct.unpack_from(f"{endian}I", wkb, offset)
+            points, offset = read_points(wkb, offset + 4, count)
+            curves.append((points, ()))
+    elif geometry_type == _COMPOUNDCURVE:
+        (count,) = struct.unpack_from(f"{endian}I", wkb, offset)
+        offset += 4
+        components: List = []
+        for _ in range(count):
+            offset = _read_geometry(wkb, offset, components)
+        curves.append(_merge_components(components))
+    elif geometry_type in (
+        _CURVEPOLYGON,
+        _MULTIPOINT,
+        _MULTILINESTRING,
+        _MULTIPOLYGON,
+        _GEOMETRYCOLLECTION,
+        _MULTICURVE,
+        _MULTISURFACE,
+    ):
+        (count,) = struct.unpack_from(f"{endian}I", wkb, offset)
+        offset += 4
+        for _ in range(count):
+            offset = _read_geometry(wkb, offset, curves)
+    else:
+        raise ValueError(f"Unsupported WKB type {wkb_type}")
+    return offset
+
+
+def _points_reader(endian: str, has_z: bool, has_m: bool):
+    """Returns a function reading points as (x, y, z, m) tuples"""
+
+    dimensions = 2 + has_z + has_m
+
+    def read_points(wkb: memoryview, offset: int, count: int):
+        values = struct.unpack_from(f"{endian}{count * dimensions}d", wkb, offset)
+        offset += 8 * count * dimensions
+        if dimensions == 4:
+            points = [values[i : i + 4] for i in range(0, len(values), 4)]
+        else:
+            points = []
+            for i in range(0, len(values), dimensions):
+                x, y = values[i], values[i + 1]
+                z = values[i + 2] if has_z else math.nan
+                m = values[i + 2 + has_z] if has_m else math.nan
+                points.append((x, y, z, m))
+        return points, offset
+
+    return read_points
+
+
+def _merge_components(components: List) -> Tuple[List, List[int]]:
+    """Merges the parts of a compound curve, whose shared vertices are counted once"""
+
+    points: List = []
+    curve_vertices: List[int] = []
+    for component_points, component_curve_vertices in components:
+        skip = 1 if points else 0
+        first = len(points) - skip
+        curve_vertices.extend(first + i for i in component_curve_vertices)
+        points.extend(component_points[skip:])
+    return points, curve_vertices
+
+
+def match_arcs(
+    snap_points: List[SnapCurvePoint],
+    neighbours: List[List[SnapCurvePoint]],
+    tolerance: float,
+    fids: Optional[Collection[int]] = None,
+) -> List[Move]:
+    """Returns the moves that snap the given arcs centers onto equivalent neighbours.
+
+    This is the batch equivalent of SnapCurvePoint.snaps_to, testing all snap points
+    against their candidate neighbours (as returned by MiniIndex.get_neighbours_bulk) in
+    a single pass on the precomputed coordinates.
+
+    When two of the harmonized features (`fids`, by default the ones of the given snap
+    points) share an arc, only one of them snaps to the other (the lower id one), so
+    that they don't swap their arc centers. Features of other layers than the one of
+    the snap points are never harmonized, so they are always snapped to.
+    """
+
+    tolerance2 = tolerance * tolerance
+    if fids is None:
+        fids = {snap_point.fid for snap_point in snap_points}
+    moves = []
+    for snap_point, candidates in zip(snap_points, neighbours):
+        fid = snap_point.fid
+        layer_id = snap_point.layer_id
+        a_x, a_y = snap_point.start
+        c_x, c_y = snap_point.end
+        o_x, o_y = snap_point.center
+        for other in candidates:
+            if other.layer_id == layer_id:
+                # Dont snap the feature against itself
+                if other.fid == fid:
+                    continue
+
+                # Dont snap both ways between changed features
+                if other.fid < fid and other.fid in fids:
+                    continue
+
+            # Test if circles are equivalent (same center point within tolerance), first
+            # as it rejects most arcs sharing an endpoint with a single test
+            b_o_x, b_o_y = other.center
+            if (o_x - b_o_x) ** 2 + (o_y - b_o_y) ** 2 > tolerance2:
+                continue
+
+            # Test if start and end points are equal (in both directions)
+            b_a_x, b_a_y = other.start
+            b_c_x, b_c_y = other.end
+            if not (
+                (a_x - b_a_x) ** 2 + (a_y - b_a_y) ** 2 <= tolerance2
+                and (c_x - b_c_x) ** 2 + (c_y - b_c_y) ** 2 <= tolerance2
+            ) and not (
+                (a_x - b_c_x) ** 2 + (a_y - b_c_y) ** 2 <= tolerance2
+                and (c_x - b_a_x) ** 2 + (c_y - b_a_y) ** 2 <= tolerance2
+            ):
+                continue
+
+            moves.append(
+                (
+                    fid,
+                    snap_point.vertex_nr,
+                    other.fid,
+                    other.mid[0],
+                    other.mid[1],
+                    other.z,
+                    other.m,
+                )
+            )
+
+    return moves
+
+
+class MiniIndex:
+    """Specialized index that indexes arcs by start/endpoint for fast retrieval.
+
+    Arcs are stored in a grid of `tolerance` sized cells under both their start and end
+    points, so the index ignores segment direction. Queries probe the cells around the
+    start point of the searched arc, so that endpoints lying on both sides of a cell
+    boundary are still found. Cells are relative to a local origin (by default the
+    first indexed point) to stay accurate with large coordinates.
+
+    Arcs are stored along with the cell of their circle center, so that arcs sharing an
+    endpoint but not the circle (e.g. consecutive arcs of a ring) are filtered out
+    before being returned as candidates.
+    """
+
+    def __init__(self, tolerance, origin: Optional[Point] = None):
+        self.tolerance = tolerance
+        self.origin = origin
+        self.index: Dict[
+            Tuple[int, int], List[Tuple[Tuple[int, int], SnapCurvePoint]]
+        ] = defaultdict(list)
+
+    def _make_cell(self, point: Point) -> Tuple[int, int]:
+        if self.origin is None:
+            self.origin = point
+        return (
+            int((point[0] - self.origin[0]) // self.tolerance),
+            int((point[1] - self.origin[1]) // self.tolerance),
+        )
+
+    def _make_keys(self, snap_point: SnapCurvePoint) -> Tuple[Tuple[int, int], ...]:
+        start_cell = self._make_cell(snap_point.start)
+        end_cell = self._make_cell(snap_point.end)
+        if start_cell == end_cell:
+            return (start_cell,)
+        return (start_cell, end_cell)
+
+    def add_snap_point(self, snap_point: SnapCurvePoint):
+        # Endpoints first, as centers can be far away, e.g. (0, 0) for straight arcs
+        keys = self._make_keys(snap_point)
+        entry = (self._make_cell(snap_point.center), snap_point)
+        for key in keys:
+            self.index[key].append(entry)
+
+    def add_snap_points(self, snap_points: Iterable[SnapCurvePoint]):
+        for snap_point in snap_points:
+            self.add_snap_point(snap_point)
+
+    def remove_snap_point(self, snap_point: SnapCurvePoint):
+        for key in self._make_keys(snap_point):
+            remaining = [
+                entry for entry in self.index.get(key, []) if entry[1] is not snap_point
+            ]
+            if remaining:
+                self.index[key] = remaining
+            else:
+                self.index.pop(key, None)
+
+    def get_neighbours(self, snap_point: SnapCurvePoint) -> List[SnapCurvePoint]:
+        """Returns the arcs having an endpoint near the start point of the given arc,
+        and their circle center near the one of the given arc"""
+
+        cell_x, cell_y = self._make_cell(snap_point.start)
+        center_x, center_y = self._make_cell(snap_point.center)
+        neighbours = []
+        seen = set()
+        for x in (cell_x - 1, cell_x, cell_x + 1):
+            for y in (cell_y - 1, cell_y, cell_y + 1):
+                for (other_x, other_y), other in self.index.get((x, y), []):
+                    # Centers within tolerance are at most one cell apart
+                    if abs(other_x - center_x) > 1 or abs(other_y - center_y) > 1:
+                        continue
+                    # Short arcs may be in two of the probed cells
+                    if id(other) not in seen:
+                        seen.add(id(other))
+                        neighbours.append(other)
+        return neighbours
+
+    def get_neighbours_bulk(
+        self, snap_points: Iterable[SnapCurvePoint]
+    ) -> List[List[SnapCurvePoint]]:
+        return [self.get_neighbours(snap_point) for snap_point in snap_points]
@@ -21,22 +21,35 @@
  ***************************************************************************/
 """
 import os.path
-from typing import List
+from functools import partial
+from typing import Dict, FrozenSet, List, Set
 
-import sip
-from processing.gui import AlgorithmExecutor
 from qgis.core import (
     QgsApplication,
     QgsFeatureRequest,
     QgsGeometry,
     QgsMapLayerType,
-    QgsVertexId,
+    QgsProject,
+    QgsRectangle,
+    QgsVectorDataProvider,
+    QgsWkbTypes,
 )
+from qgis.PyQt.QtCore import QTimer
 from qgis.PyQt.QtGui import QIcon
 from qgis.PyQt.QtWidgets import QAction
 
 from . import settings
-from .utils import MiniIndex, SnapCurvePoint
+from .kernel import cached_circle_center_radius
+from .profiling import profiler
+from .provider import Provider
+from .tasks import PostProcessTask
+from .utils import (
+    LayerArcIndex,
+    SnapPointsCache,
+    curvify_geometries,
+    harmonize_geometries,
+    has_curves,
+)
 
 
 class Plugin:
@@ -49,9 +62,15 @@ class Plugin:
     def _icon(self, name):
         return QIcon(os.path.join(os.path.dirname(__file__), "icons", name))
 
+    def initProcessing(self):
+        self.provider = Provider()
+        QgsApplication.processingRegistry().addProvider(self.provider)
+
     def initGui(self):
         """Create the menu entries and toolbar icons inside the QGIS GUI."""
 
+        self.initProcessing()
+
         self.toolbar = self.iface.addToolBar("Autocurve")
 
         self.auto_curve_action = QAction(
@@ -68,169 +87,715 @@ class Plugin:
         self.harmonize_arcs_action.toggled.connect(self.toggle_harmonize_arcs)
         self.toolbar.addAction(self.harmonize_arcs_action)
 
-        self.watched_layers = set()
-        self.changed_fids = set()
+        self.harmonized_layers_action = QAction(
+            "Harmonize arcs across the selected layers", self.iface.mainWindow()
+        )
+        self.harmonized_layers_action.triggered.connect(self.harmonize_selected_layers)
+        self.iface.addPluginToMenu("Autocurve", self.harmonized_layers_action)
+
+        self.iface.optionsChanged.connect(settings.invalidate)
+
+        # Layers whose edits are followed, and all the ones that may be edited
+        self.watched_layers = {}
+        self.armed_layers = {}
+        self.watching = False
+        # Arc indexes by the ids of the layers they hold
+        self.arc_indexes: Dict[FrozenSet[str], LayerArcIndex] = {}
+        self.snap_points_caches: Dict[str, SnapPointsCache] = {}
+        # Features changed by the running edit command, by layer id
+        self.changed_fids: Dict[str, Set[int]] = {}
+        # Features waiting for post-processing, by layer
+        self.pending_fids = {}
+        self.task = None
         self._prevent_recursion = False
+        self._applying_geometries = False
 
-        self.watch_layer(self.iface.activeLayer())
-        self.iface.currentLayerChanged.connect(self.watch_layer)
+        # Post-processing can be deferred until editing pauses
+        self.post_process_timer = QTimer()
+        self.post_process_timer.setSingleShot(True)
+        self.post_process_timer.timeout.connect(self.post_process)
 
+        # Layers are only watched once one of the actions is enabled
         self.auto_curve_action.setChecked(settings.autocurve_enabled())
         self.harmonize_arcs_action.setChecked(settings.harmonize_enabled())
 
     def unload(self):
         self.iface.mainWindow().removeToolBar(self.toolbar)
+        self.iface.removePluginMenu("Autocurve", self.harmonized_layers_action)
+        QgsApplication.processingRegistry().removeProvider(self.provider)
+        self.iface.optionsChanged.disconnect(settings.invalidate)
+
+        # Don't lose pending changes
+        self.flush_post_process()
+        self.post_process_timer.timeout.disconnect(self.post_process)
 
-        for layer in self.watched_layers:
-            if not sip.isdeleted(layer):
-                layer.geometryChanged.disconnect(self.add_to_changelog)
-                layer.featureAdded.disconnect(self.add_to_changelog)
-                layer.editCommandStarted.connect(self.reset_changelog)
-                layer.editCommandEnded.connect(self.run_after_edit_command)
-        self.watched_layers = set()
+        if self.watching:
+            self.stop_watching()
 
     def toggle_auto_curve(self, checked):
         settings.set_autocurve_enabled(checked)
+        self.update_watching()
+        self.update_watched_layers()
 
     def toggle_harmonize_arcs(self, checked):
         settings.set_harmonize_enabled(checked)
+        self.update_watching()
+        self.update_watched_layers()
+
+    def update_watching(self):
+        """Follows the edits of the project only while one of the actions is enabled"""
+
+        enabled = (
+            self.auto_curve_action.isChecked() or self.harmonize_arcs_action.isChecked()
+        )
+        if enabled and not self.watching:
+            self.start_watching()
+        elif not enabled and self.watching:
+            self.stop_watching()
+
+    def start_watching(self):
+        self.watching = True
+        project = QgsProject.instance()
+        project.layersAdded.connect(self.arm_layers)
+        self.arm_layers(project.mapLayers().values())
+
+    def stop_watching(self):
+        # Let a running task finish, its layer is not followed anymore afterwards
+        self.flush_post_process()
+
+        QgsProject.instance().layersAdded.disconnect(self.arm_layers)
+        for connections_by_layer in (self.armed_layers, self.watched_layers):
+            for layer, connections in connections_by_layer.items():
+                if not _is_deleted(layer):
+                    for signal, slot in connections:
+                        signal.disconnect(slot)
+        self.armed_layers = {}
+        self.watched_layers = {}
+
+        # Edits are not followed anymore, so indexes would get outdated
+        self.arc_indexes = {}
+        self.snap_points_caches = {}
+        self.watching = False
+
+    def arm_layers(self, layers):
+        """Watches the given layers while they are edited, if they can be post-processed"""
+
+        for layer in layers:
+            if layer in self.armed_layers or not _can_post_process(layer):
+                continue
+            connections = [
+                (layer.editingStarted, partial(self.watch_layer, layer)),
+                (layer.editingStopped, partial(self.unwatch_layer, layer)),
+                (layer.willBeDeleted, partial(self.forget_layer, layer)),
+            ]
+            for signal, slot in connections:
+                signal.connect(slot)
+            self.armed_layers[layer] = connections
+            if layer.isEditable():
+                self.watch_layer(layer)
+
+    def update_watched_layers(self):
+        """Watches the edited layers the enabled actions apply to, and only them"""
+
+        for layer in list(self.armed_layers):
+            if _is_deleted(layer) or not layer.isEditable():
+                continue
+            if self.post_processing_applies(layer):
+                self.watch_layer(layer)
+            else:
+                self.unwatch_layer(layer)
+
+    def post_processing_applies(self, layer) -> bool:
+        """Returns whether the enabled actions can change features of the layer"""
+
+        if self.auto_curve_action.isChecked():
+            return True
+        # Layers that can't store curves have no arcs to harmonize
+        return self.harmonize_arcs_action.isChecked() and QgsWkbTypes.isCurvedType(
+            layer.wkbType()
+        )
+
+    def harmonize_selected_layers(self):
+        """Harmonizes arcs across the layers selected in the layer tree"""
+
+        layers = self.iface.layerTreeView().selectedLayers()
+        self.set_harmonized_layers(layers)
+        if len(layers) > 1:
+            message = f"Arcs are harmonized across {len(layers)} layers"
+        else:
+            message = "Arcs are harmonized within each layer"
+        self.iface.messageBar().pushInfo("Autocurve", message)
+
+    def set_harmonized_layers(self, layers):
+        """Stores the layers to harmonize arcs across in the project"""
+
+        layers = [
+            layer
+            for layer in layers
+            if layer is not None and layer.type() == QgsMapLayerType.VectorLayer
+        ]
+        settings.set_harmonized_layer_ids(
+            [layer.id() for layer in layers] if len(layers) > 1 else []
+        )
+
+    def harmonized_layers(self, layer) -> List:
+        """Returns the layers the arcs of the layer are harmonized with, itself first"""
+
+        layer_ids = settings.harmonized_layer_ids()
+        if layer.id() not in layer_ids:
+            return [layer]
+
+        layers = [layer]
+        for layer_id in layer_ids:
+            other = QgsProject.instance().mapLayer(layer_id)
+            if (
+                other is None
+                or other is layer
+                or other.type() != QgsMapLayerType.VectorLayer
+                # Arcs can only be compared in the same coordinates
+                or other.crs() != layer.crs()
+            ):
+                continue
+            layers.append(other)
+        return layers
 
     def watch_layer(self, layer):
-        # We watch geometryChanged and featureAdded on all layers
+        """Follows the edits of the layer, while it is in editing mode"""
+
+        if layer not in self.watched_layers and self.post_processing_applies(layer):
+            connections = [
+                (layer.geometryChanged, partial(self.feature_changed, layer)),
+                (layer.featureAdded, partial(self.feature_changed, layer)),
+                (layer.editCommandStarted, partial(self.reset_changelog, layer)),
+                (layer.editCommandEnded, partial(self.run_after_edit_command, layer)),
+                (layer.editCommandDestroyed, self.schedule_post_process),
+                # Make sure pending changes are processed before they get committed
+                (layer.beforeCommitChanges, self.flush_post_process),
+                (layer.afterRollBack, partial(self.discard_post_process, layer)),
+                # Keep the arc index of the layer up to date
+                (layer.featureDeleted, partial(self.remove_from_arc_index, layer)),
+                (
+                    layer.committedFeaturesAdded,
+                    partial(self.update_arc_index_after_commit, layer),
+                ),
+                (layer.afterRollBack, partial(self.drop_arc_index, layer)),
+            ]
+            for signal, slot in connections:
+                signal.connect(slot)
+            self.watched_layers[layer] = connections
+
+    def unwatch_layer(self, layer):
+        """Stops following the edits of the layer, e.g. once it left editing mode.
+
+        Its arc indexes are dropped, as the data can change without being followed
+        (e.g. the provider being reloaded), and rebuilt once editing starts again.
+        """
+
+        for signal, slot in self.watched_layers.pop(layer, []):
+            signal.disconnect(slot)
+        self.changed_fids.pop(layer.id(), None)
+        self.discard_post_process(layer)
+        self.drop_arc_index(layer)
+
+    def forget_layer(self, layer):
+        """Drops everything about a layer that is being deleted"""
+
+        self.unwatch_layer(layer)
+        for signal, slot in self.armed_layers.pop(layer, []):
+            signal.disconnect(slot)
+
+    def reset_changelog(self, layer):
+        # Attribute only commands don't change the changelog, so it's only dropped
+        self.changed_fids.pop(layer.id(), None)
+
+        # Don't post-process while an edit command is running
+        self.post_process_timer.stop()
+
+    def feature_changed(self, layer, fid, geometry=None):
+        """Records a feature added or changed by the running edit command"""
+
+        self.add_to_changelog(layer, fid)
+        self.update_arc_index(layer, fid, geometry)
+
+    def add_to_changelog(self, layer, fid, geometry=None):
+        self.changed_fids.setdefault(layer.id(), set()).add(fid)
+
+    def snap_points_cache(self, layer) -> SnapPointsCache:
+        """Returns the snap points cache of the layer"""
+
+        cache = self.snap_points_caches.get(layer.id())
+        if cache is None:
+            cache = SnapPointsCache(max_size=settings.cache_size(), layer_id=layer.id())
+            self.snap_points_caches[layer.id()] = cache
+        return cache
+
+    def arc_index(self, layer, tolerance: float, extent: QgsRectangle) -> LayerArcIndex:
+        """Returns the arc index of the layer and of the ones harmonized with it,
+        holding at least all their arcs within the extent.
+
+        The index is created on first use or if the tolerance changed, and is then
+        filled region by region as edits happen. To bound memory, it is rebuilt around
+        the extent once it holds more features than the cache size (per layer).
+        """
+
+        layers = self.harmonized_layers(layer)
+        layer_ids = frozenset(indexed_layer.id() for indexed_layer in layers)
+        index = self.arc_indexes.get(layer_ids)
         if (
-            layer
-            and layer.type() == QgsMapLayerType.VectorLayer
-            and layer not in self.watched_layers
+            index is None
+            or index.tolerance != tolerance
+            or len(index.indexed_fids) > settings.cache_size() * len(layers)
         ):
-            layer.geometryChanged.connect(self.add_to_changelog)
-            layer.featureAdded.connect(self.add_to_changelog)
-            layer.editCommandStarted.connect(self.reset_changelog)
-            layer.editCommandEnded.connect(self.run_after_edit_command)
-            self.watched_layers.add(layer)
+            # Indexes of a previous configuration of harmonized layers are outdated
+            for other_ids in [ids for ids in self.arc_indexes if ids & layer_ids]:
+                del self.arc_indexes[other_ids]
 
-    def reset_changelog(self):
-        self.changed_fids = set()
+            # Layers are watched while edited, so the index follows all their edits
+            index = LayerArcIndex(tolerance=tolerance, layer_ids=layer_ids)
+            self.arc_indexes[layer_ids] = index
 
-    def add_to_changelog(self, fid, geometry=None):
-        self.changed_fids.add(fid)
+        for indexed_layer in layers:
+            self._prefetch_arcs(index, indexed_layer, extent)
+        return index
 
-    def run_after_edit_command(self):
-        """This is run after an edit command finished"""
+    def _prefetch_arcs(self, index: LayerArcIndex, layer, extent: QgsRectangle):
+        """Indexes the arcs of the layer within the extent, unless already done"""
 
-        if not self.changed_fids:
-            # No geometries have changed, no need to run
+        # An empty extent would be no filter at all, and read the whole layer
+        if extent.isEmpty() or index.covers(extent, layer.id()):
+            return
+
+        # Layers that can't store curves have no arcs to snap to
+        if QgsWkbTypes.isCurvedType(layer.wkbType()):
+            cache = self.snap_points_cache(layer)
+            request = QgsFeatureRequest().setFilterRect(extent).setNoAttributes()
+            prefetched = 0
+            for feature in layer.getFeatures(request):
+                prefetched += 1
+                if index.has_feature(feature.id(), layer.id()):
+                    # Already indexed, and kept up to date since then
+                    continue
+                snap_points = cache.get(feature.id(), feature.geometry())
+                index.set_snap_points(feature.id(), snap_points, layer.id())
+            profiler.count("prefetched", prefetched)
+
+        index.add_covered_extent(extent, layer.id())
+
+    def _arc_indexes_of(self, layer) -> List[LayerArcIndex]:
+        """Returns the built arc indexes holding the arcs of the layer"""
+        return [
+            index
+            for index in self.arc_indexes.values()
+            if layer.id() in index.layer_ids
+        ]
+
+    def update_arc_index(self, layer, fid, geometry=None):
+        """Reindexes the arcs of a feature that was added or changed"""
+
+        if self._applying_geometries:
+            # Our own changes are reindexed all at once after being applied
+            return
+
+        cache = self.snap_points_cache(layer)
+        cache.invalidate(fid)
+
+        indexes = self._arc_indexes_of(layer)
+        if not indexes:
+            # Not built yet, it will include the change once built
             return
 
+        if geometry is None:
+            geometry = layer.getFeature(fid).geometry()
+        snap_points = cache.get(fid, geometry)
+        for index in indexes:
+            index.set_snap_points(fid, snap_points, layer.id())
+
+    def update_arc_index_after_commit(self, layer, layer_id, features):
+        """Replaces temporary feature ids by the ones assigned by the provider on commit"""
+
+        cache = self.snap_points_cache(layer)
+        for index in self._arc_indexes_of(layer):
+            index.remove_uncommitted_features(layer.id())
+            for feature in features:
+                snap_points = cache.get(feature.id(), feature.geometry())
+                index.set_snap_points(feature.id(), snap_points, layer.id())
+
+    def remove_from_arc_index(self, layer, fid):
+        self.snap_points_cache(layer).invalidate(fid)
+
+        for index in self._arc_indexes_of(layer):
+            index.remove_feature(fid, layer.id())
+
+    def drop_arc_index(self, layer, *args):
+        """Discards the arc indexes holding the layer and its cached snap points"""
+        for index in self._arc_indexes_of(layer):
+            del self.arc_indexes[index.layer_ids]
+        self.snap_points_caches.pop(layer.id(), None)
+
+    def run_after_edit_command(self, layer):
+        """This is run after an edit command of the layer finished"""
+
         if self._prevent_recursion:
             # Avoiding recursion as the algorithm will also trigger geometryChanged
             return
 
+        changed_fids = self.changed_fids.pop(layer.id(), None)
+        if not changed_fids:
+            # No geometries have changed, no need to run
+            self.schedule_post_process()
+            return
+
+        if not layer.isSpatial():
+            return
+
+        # Accumulate the changes until post-processing runs
+        self.pending_fids.setdefault(layer, set()).update(changed_fids)
+        self.schedule_post_process()
+
+    def schedule_post_process(self):
+        """Runs post-processing on pending changes once editing paused for the delay"""
+
+        if not self.pending_fids:
+            return
+
+        delay = settings.delay()
+        if delay > 0:
+            # Restarting the timer on each call coalesces consecutive edit commands
+            self.post_process_timer.start(delay)
+        else:
+            self.post_process()
+
+    def flush_post_process(self, *args):
+        """Runs post-processing on pending changes immediately"""
+
+        while self.task is not None:
+            # Wait (without timeout) for the background computation, so its results
+            # get committed too
+            task = self.task
+            if not task.waitForFinished(0):
+                # The changes are then processed again, right below
+                task.cancel()
+                self.task = None
+                profiler.end_run()
+                self.pending_fids.setdefault(task.layer, set()).update(
+                    task.original_wkbs
+                )
+                continue
+            self.apply_task_results(task)
+
+        if self.pending_fids:
+            self.post_process(background=False)
+
+    def discard_post_process(self, layer, *args):
+        """Drops pending changes of the layer, e.g. after a rollback"""
+
+        self.pending_fids.pop(layer, None)
+        if not self.pending_fids:
+            self.post_process_timer.stop()
+
+    def post_process(self, background=True):
+        """Curvifies and harmonizes all pending changes, layer by layer"""
+
+        self.post_process_timer.stop()
+
+        curvify = settings.autocurve_enabled()
+        harmonize = settings.harmonize_enabled()
+        if not curvify and not harmonize:
+            self.pending_fids = {}
+            return
+
+        # Pending changes will be processed once a running task finished
+        while self.pending_fids and self.task is None:
+            layer = next(iter(self.pending_fids))
+            fids = self.pending_fids.pop(layer)
+            if _is_deleted(layer) or not layer.isEditable():
+                continue
+            self.post_process_layer(layer, fids, curvify, harmonize, background)
+
+    def post_process_layer(self, layer, fids, curvify, harmonize, background=True):
+        """Curvifies and harmonizes the given features of the layer"""
+
+        # Read the tolerances once for the whole run. Features are curvified with the
+        # ones of their layer, but layers harmonized together share their arc index,
+        # thus the largest of their distance tolerances
+        tolerances = settings.layer_tolerances(layer)
+        harmonize_tolerance = max(
+            settings.layer_tolerances(harmonized_layer).distance
+            for harmonized_layer in self.harmonized_layers(layer)
+        )
+
+        profiler.start_run(
+            settings.profiling_enabled(),
+            settings.profiling_trace(),
+            layer=layer.name(),
+            features=len(fids),
+        )
+
+        # Large edits are computed in the background (if possible without processing)
+        threshold = settings.background_threshold()
+        if (
+            background
+            and 0 < threshold <= len(fids)
+            and QgsWkbTypes.isCurvedType(layer.wkbType())
+        ):
+            self.post_process_in_background(
+                layer, fids, tolerances, harmonize_tolerance, curvify, harmonize
+            )
+            return
+
         # Avoid recursion as the following code will trigger geometryChanged
         self._prevent_recursion = True
 
-        # Select affected polygons
-        layer = self.iface.activeLayer()
-        layer.selectByIds(list(self.changed_fids))
-
         # Run autocurve procedure
-        if settings.autocurve_enabled():
-            self.curvify()
+        if curvify:
+            self.curvify(layer, fids, tolerances)
 
         # Run harmonize procedure
-        if settings.harmonize_enabled():
-            self.harmonize_arcs()
-
-        # Remove selection
-        layer.removeSelection()
+        if harmonize:
+            self.harmonize_arcs(layer, fids, harmonize_tolerance)
 
         # Disable recursion prevention
         self._prevent_recursion = False
 
-    def curvify(self):
-        """Runs the convert to curves algorithm in place"""
-
-        # Run converttocurves in-place
-        alg = QgsApplication.processingRegistry().createAlgorithmById(
-            "native:converttocurves"
-        )
-        AlgorithmExecutor.execute_in_place(
-            alg, {"DISTANCE": settings.distance(), "ANGLE": settings.angle()}
+        profiler.end_run()
+
+    def post_process_in_background(
+        self,
+        layer,
+        fids,
+        tolerances: settings.Tolerances,
+        harmonize_tolerance: float,
+        curvify,
+        harmonize,
+    ):
+        """Starts a task computing the post-processing of the given features"""
+
+        geometries = self._get_geometries(layer, fids)
+
+        # The index is filled on the main thread, as it reads the layer, and the task
+        # gets its own copy of the neighbours, as the index keeps following the edits
+        index = None
+        # Without curvifying, only features having arcs yet can be harmonized
+        with_arcs = geometries
+        if not curvify:
+            with_arcs = {
+                fid: geometry
+                for fid, geometry in geometries.items()
+                if has_curves(geometry)
+            }
+        if harmonize and with_arcs:
+            extent = self._search_extent(with_arcs, harmonize_tolerance)
+            with profiler.stage("index"):
+                index = self.arc_index(layer, harmonize_tolerance, extent).copy_region(
+                    extent, excluded={(layer.id(), fid) for fid in geometries}
+                )
+
+        self.task = PostProcessTask(
+            layer,
+            geometries,
+            tolerances,
+            curvify,
+            index,
+            on_finished=self.apply_task_results,
         )
+        QgsApplication.taskManager().addTask(self.task)
 
-    def harmonize_arcs(self):
-        """Iterates through all changed features and snaps arc centers to neighbouring arc centers"""
+    def apply_task_results(self, task: PostProcessTask):
+        """Applies the geometries computed by a finished task"""
 
-        layer = self.iface.activeLayer()
-
-        if not layer or not layer.isSpatial():
+        if task is not self.task:
+            # Already applied
             return
+        self.task = None
 
-        layer.beginEditCommand("Harmonize arcs")
+        layer = task.layer
+        if task.completed and not _is_deleted(layer) and layer.isEditable():
+            # Skip features that were edited in the meantime
+            new_geoms = {
+                fid: new_geom
+                for fid, new_geom in task.new_geoms.items()
+                if layer.getFeature(fid).geometry().asWkb() == task.original_wkbs[fid]
+            }
 
-        for feature in layer.selectedFeatures():
+            self._prevent_recursion = True
+            self._apply_geometries(layer, new_geoms, "Autocurve")
+            self._prevent_recursion = False
 
-            # Find all arcs points
-            snap_points = self._get_snap_points(feature)
+        profiler.end_run()
 
-            # Skip if not curved
-            if not snap_points:
-                continue
+        # Process changes that happened while the task was running
+        self.schedule_post_process()
 
-            # Find all neighbours to test against
-            request = QgsFeatureRequest()
-            request.setDistanceWithin(feature.geometry(), settings.distance())
-            neighbours = list(layer.getFeatures(request))
+    def curvify(self, layer, fids, tolerances: settings.Tolerances):
+        """Converts the given features to curves"""
 
-            # Keep candidate snapping arcs
-            index = MiniIndex(tolerance=settings.distance())
-            nearby_snap_points = []
-            for neighbour in neighbours:
+        if not QgsWkbTypes.isCurvedType(layer.wkbType()):
+            # Curves can't be stored as is, let processing make the result compatible
+            self._curvify_with_processing(layer, fids, tolerances)
+            return
 
-                if neighbour.id() == feature.id():
-                    # don't compare about itself
-                    continue
+        # Convert the geometries directly, only keeping the ones that changed
+        geometries = self._get_geometries(layer, fids)
+        with profiler.stage("curvify"):
+            new_geoms = curvify_geometries(
+                geometries, tolerances.distance, tolerances.angle
+            )
+        self._apply_geometries(layer, new_geoms, "Convert to curves")
 
-                for nearby_snap_point in self._get_snap_points(neighbour):
-                    nearby_snap_points.append(nearby_snap_point)
-                    index.add_snap_point(nearby_snap_point)
+    def _curvify_with_processing(self, layer, fids, tolerances: settings.Tolerances):
+        """Runs the convert to curves algorithm in place on the given features"""
 
-            # This will hold the new geometry if it needs changes
-            new_geom = None
+        # The in-place executor works on the selection, so we restore the user's after
+        user_selection = layer.selectedFeatureIds()
+        layer.selectByIds(list(fids))
 
-            # Iterate on all arc vertics, combinined will all neighbouring arc vertices
-            for snap_point in snap_points:
+        # Imported on first use, as the processing GUI is slow to load
+        from processing.gui import AlgorithmExecutor
 
-                for nearby_snap_point in index.get_neighbours(snap_point):
+        # Run converttocurves in-place
+        with profiler.stage("curvify_processing"):
+            alg = QgsApplication.processingRegistry().createAlgorithmById(
+                "native:converttocurves"
+            )
+            # Run on the edited layer, which is not necessarily the active one
+            AlgorithmExecutor.execute_in_place_run(
+                alg,
+                {
+                    "INPUT": layer,
+                    "DISTANCE": tolerances.distance,
+                    "ANGLE": tolerances.angle,
+                },
+            )
+
+        layer.selectByIds(user_selection)
+
+    def harmonize_arcs(self, layer, fids, tolerance: float):
+        """Snaps arc centers of the given features to neighbouring arc centers"""
+
+        cache = self.snap_points_cache(layer)
+        cache_hits, cache_misses = cache.hits, cache.misses
+        circle_hits = cached_circle_center_radius.cache_info().hits
+
+        geometries = self._get_geometries(layer, fids)
+
+        # Only features with arcs are harmonized, the other ones need no neighbours
+        with profiler.stage("snap_points"):
+            geometries = {
+                fid: geometry
+                for fid, geometry in geometries.items()
+                if cache.get(fid, geometry)
+            }
+
+        new_geoms = {}
+        if geometries:
+            # Candidate snapping arcs around the changed features, read all at once
+            with profiler.stage("index"):
+                index = self.arc_index(
+                    layer,
+                    tolerance,
+                    self._search_extent(geometries, tolerance),
+                )
+            new_geoms = harmonize_geometries(geometries, index, cache=cache)
+
+        profiler.count("cache_hits", cache.hits - cache_hits)
+        profiler.count("cache_misses", cache.misses - cache_misses)
+        profiler.count(
+            "circle_hits", cached_circle_center_radius.cache_info().hits - circle_hits
+        )
+
+        self._apply_geometries(layer, new_geoms, "Harmonize arcs")
+
+    def _get_geometries(self, layer, fids) -> Dict[int, QgsGeometry]:
+        """Returns the geometries of the given features"""
+
+        request = QgsFeatureRequest().setFilterFids(list(fids))
+        request.setNoAttributes()
+        with profiler.stage("fetch"):
+            return {
+                feature.id(): feature.geometry()
+                for feature in layer.getFeatures(request)
+            }
+
+    def _search_extent(
+        self, geometries: Dict[int, QgsGeometry], tolerance: float
+    ) -> QgsRectangle:
+        """Returns the extent in which the given geometries can find arcs to snap to,
+        which is empty if all of them are null"""
+
+        extent = QgsRectangle()
+        extent.setMinimal()
+        for geometry in geometries.values():
+            if not geometry.isNull():
+                extent.combineExtentWith(geometry.boundingBox())
+        if extent.xMinimum() > extent.xMaximum():
+            return QgsRectangle()
+        extent.grow(tolerance)
+        return extent
+
+    def _apply_geometries(self, layer, new_geoms: Dict[int, QgsGeometry], title):
+        """Changes the given geometries in a single edit command"""
+
+        if not new_geoms:
+            return
 
-                    # Perform the actual snapping test
-                    if snap_point.snaps_to(nearby_snap_point):
+        # Freeze the canvas so it's only repainted once all changes are applied
+        canvas = self.iface.mapCanvas()
+        was_frozen = canvas.isFrozen()
+        canvas.freeze(True)
+
+        self._applying_geometries = True
+        try:
+            with profiler.stage("apply"):
+                layer.beginEditCommand(title)
+                for fid, new_geom in new_geoms.items():
+                    layer.changeGeometry(fid, new_geom)
+                layer.endEditCommand()
+        finally:
+            self._applying_geometries = False
+            canvas.freeze(was_frozen)
+        profiler.count("changed", len(new_geoms))
+
+        with profiler.stage("reindex"):
+            self._update_arc_index_bulk(layer, new_geoms)
+
+        layer.triggerRepaint()
+
+    def _update_arc_index_bulk(self, layer, new_geoms: Dict[int, QgsGeometry]):
+        """Reindexes the arcs of all given features"""
+
+        cache = self.snap_points_cache(layer)
+        for fid in new_geoms:
+            cache.invalidate(fid)
+
+        indexes = self._arc_indexes_of(layer)
+        if not indexes:
+            return
 
-                        # Clone the geometry if not already cloned
-                        if new_geom is None:
-                            new_geom = QgsGeometry(feature.geometry())
+        for fid, new_geom in new_geoms.items():
+            snap_points = cache.get(fid, new_geom)
+            for index in indexes:
+                index.set_snap_points(fid, snap_points, layer.id())
 
-                        success = new_geom.moveVertex(
-                            nearby_snap_point.vertex, snap_point.vertex_nr
-                        )
-                        assert success
 
-            # Apply the changed geometry
-            if new_geom is not None:
-                layer.changeGeometry(feature.id(), new_geom)
+def _is_deleted(obj) -> bool:
+    # Imported on first use, not to slow down QGIS startup
+    import sip
 
-        layer.endEditCommand()
+    return sip.isdeleted(obj)
 
-    def _get_snap_points(self, feature):
-        """Returns a list of snap points for the given feature"""
 
-        curved_vertices: List[SnapCurvePoint] = []
-        vertex_id = QgsVertexId()
-        while True:
-            found, point = feature.geometry().constGet().nextVertex(vertex_id)
-            if not found:
-                break
-            if vertex_id.type is QgsVertexId.VertexType.Curve:
-                vertex_nr = feature.geometry().vertexNrFromVertexId(vertex_id)
-                curved_vertices.append(SnapCurvePoint(feature, vertex_nr, point))
+def _can_post_process(layer) -> bool:
+    """Returns whether features of the layer can ever be post-processed, i.e. whether it
+    is an editable line or polygon layer"""
 
-        return curved_vertices
+    if layer.type() != QgsMapLayerType.VectorLayer or not layer.isValid():
+        return False
+    if layer.geometryType() not in (
+        QgsWkbTypes.LineGeometry,
+        QgsWkbTypes.PolygonGeometry,
+    ):
+        return False
+    capabilities = layer.dataProvider().capabilities()
+    return not layer.readOnly() and bool(
+        capabilities & QgsVectorDataProvider.ChangeGeometries
+    )
@@ -0,0 +1,89 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+
+from qgis.core import Qgis, QgsMessageLog
+
+# Size from which the trace file is rolled over
+TRACE_MAX_SIZE = 5 * 1024 * 1024
+
+
+class Profiler:
+    """Records durations of post-processing stages and counters of handled items.
+
+    Nothing is collected unless a run was started with profiling enabled. Stage
+    durations and counters are summed per run, and each finished run is logged to the
+    message log and optionally appended to a JSON lines trace file.
+    """
+
+    def __init__(self):
+        self.current = None
+        self.trace_path = None
+        self._start = None
+
+    @property
+    def active(self):
+        return self.current is not None
+
+    def start_run(self, enabled: bool, trace_path=None, **info):
+        if not enabled:
+            self.current = None
+            return
+        self.current = {"time": time.time(), **info, "stages": {}, "counts": {}}
+        self.trace_path = trace_path
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        current = self.current
+        if current is None:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stages = current["stages"]
+            stages[name] = stages.get(name, 0) + time.perf_counter() - start
+
+    def count(self, name, value=1):
+        current = self.current
+        if current is not None:
+            current["counts"][name] = current["counts"].get(name, 0) + value
+
+    def end_run(self):
+        run = self.current
+        self.current = None
+        if run is None:
+            return
+        run["total"] = time.perf_counter() - self._start
+
+        QgsMessageLog.logMessage(self.format_run(run), "Autocurve", Qgis.Info)
+        if self.trace_path:
+            self._write_trace(run)
+
+    def format_run(self, run) -> str:
+        stages = ", ".join(
+            f"{name} {duration * 1000:.1f} ms"
+            for name, duration in run["stages"].items()
+        )
+        counts = ", ".join(f"{name} {value}" for name, value in run["counts"].items())
+        return f"Post-processed in {run['total'] * 1000:.1f} ms ({stages}), {counts}"
+
+    def _write_trace(self, run):
+        try:
+            if (
+                os.path.exists(self.trace_path)
+                and os.path.getsize(self.trace_path) > TRACE_MAX_SIZE
+            ):
+                os.replace(self.trace_path, f"{self.trace_path}.1")
+            with open(self.trace_path, "a") as f:
+                f.write(json.dumps(run) + "\n")
+        except OSError as e:
+            QgsMessageLog.logMessage(
+                f"Could not write trace: {e}", "Autocurve", Qgis.Warning
+            )
+
+
+profiler = Profiler()
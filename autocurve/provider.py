@@ -0,0 +1,131 @@
+import os.path
+
+from qgis.core import (
+    QgsFeatureRequest,
+    QgsFeatureSink,
+    QgsProcessing,
+    QgsProcessingAlgorithm,
+    QgsProcessingException,
+    QgsProcessingMultiStepFeedback,
+    QgsProcessingParameterDistance,
+    QgsProcessingParameterFeatureSink,
+    QgsProcessingParameterFeatureSource,
+    QgsProcessingParameterNumber,
+    QgsProcessingProvider,
+)
+from qgis.PyQt.QtGui import QIcon
+
+from . import settings
+
+
+def _icon(name):
+    return QIcon(os.path.join(os.path.dirname(__file__), "icons", name))
+
+
+class Provider(QgsProcessingProvider):
+    """Processing provider for the batch algorithms of the plugin"""
+
+    def id(self):
+        return "autocurve"
+
+    def name(self):
+        return "Autocurve"
+
+    def icon(self):
+        return _icon("autocurve.svg")
+
+    def loadAlgorithms(self):
+        self.addAlgorithm(HarmonizeArcsAlgorithm())
+
+
+class HarmonizeArcsAlgorithm(QgsProcessingAlgorithm):
+    """Harmonizes arc centers of all features of a layer"""
+
+    INPUT = "INPUT"
+    DISTANCE = "DISTANCE"
+    WORKERS = "WORKERS"
+    OUTPUT = "OUTPUT"
+
+    def name(self):
+        return "harmonizearcs"
+
+    def displayName(self):
+        return "Harmonize arcs"
+
+    def icon(self):
+        return _icon("harmonize.svg")
+
+    def shortHelpString(self):
+        return (
+            "Snaps the center points of arcs shared by neighbouring features, so that "
+            "they follow exactly the same curve. Arcs are matched in parallel by the "
+            "given number of worker processes."
+        )
+
+    def createInstance(self):
+        return HarmonizeArcsAlgorithm()
+
+    def initAlgorithm(self, config=None):
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+                self.INPUT,
+                "Input layer",
+                [QgsProcessing.TypeVectorLine, QgsProcessing.TypeVectorPolygon],
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterDistance(
+                self.DISTANCE,
+                "Distance tolerance",
+                defaultValue=settings.distance(),
+                parentParameterName=self.INPUT,
+                minValue=0,
+            )
+        )
+        self.addParameter(
+            QgsProcessingParameterNumber(
+                self.WORKERS,
+                "Worker processes",
+                type=QgsProcessingParameterNumber.Integer,
+                defaultValue=os.cpu_count() or 1,
+                minValue=1,
+            )
+        )
+        self.addParameter(QgsProcessingParameterFeatureSink(self.OUTPUT, "Harmonized"))
+
+    def processAlgorithm(self, parameters, context, feedback):
+        # Imported on first use, as multiprocessing would slow down QGIS startup
+        from .batch import harmonize_layer
+
+        source = self.parameterAsSource(parameters, self.INPUT, context)
+        distance = self.parameterAsDouble(parameters, self.DISTANCE, context)
+        if distance <= 0:
+            # Arcs are indexed in cells of the tolerance size
+            raise QgsProcessingException("The distance tolerance must be positive")
+        workers = self.parameterAsInt(parameters, self.WORKERS, context)
+
+        sink, dest_id = self.parameterAsSink(
+            parameters,
+            self.OUTPUT,
+            context,
+            source.fields(),
+            source.wkbType(),
+            source.sourceCrs(),
+        )
+
+        multi_feedback = QgsProcessingMultiStepFeedback(2, feedback)
+        new_geoms = harmonize_layer(
+            source, distance, workers=workers, feedback=multi_feedback
+        )
+
+        multi_feedback.setCurrentStep(1)
+        total = source.featureCount() or 1
+        for i, feature in enumerate(source.getFeatures(QgsFeatureRequest())):
+            if feedback.isCanceled():
+                break
+            if feature.id() in new_geoms:
+                feature.setGeometry(new_geoms[feature.id()])
+            sink.addFeature(feature, QgsFeatureSink.FastInsert)
+            multi_feedback.setProgress(100 * i / total)
+
+        return {self.OUTPUT: dest_id}
@@ -1,9 +1,35 @@
-from qgis.core import QgsSettings
+import math
+from typing import Dict, List, NamedTuple
+
+from qgis.core import (
+    QgsCoordinateReferenceSystem,
+    QgsProject,
+    QgsRectangle,
+    QgsSettings,
+    QgsUnitTypes,
+)
 
 DISTANCE_KEY = "/qgis/digitizing/convert_to_curve_distance_tolerance"
 ANGLE_KEY = "/qgis/digitizing/convert_to_curve_angle_tolerance"
+AUTO_TOLERANCES_KEY = "autocurve/auto_tolerances"
 CURVIFY_ENABLED_KEY = "autocurve/curvify_enabled"
 HARMONIZE_ENABLED_KEY = "autocurve/harmonize_enabled"
+DELAY_KEY = "autocurve/delay"
+BACKGROUND_THRESHOLD_KEY = "autocurve/background_threshold"
+CACHE_SIZE_KEY = "autocurve/cache_size"
+PROFILING_ENABLED_KEY = "autocurve/profiling_enabled"
+PROFILING_TRACE_KEY = "autocurve/profiling_trace"
+
+# Auto tolerances: coordinates are rarely stored more precisely than a millimeter
+AUTO_DISTANCE_METERS = 1e-3
+# nor than ~12 significant digits once segmentized and reprojected
+AUTO_RELATIVE_PRECISION = 1e-12
+# and digitized arcs rarely have segments shorter than a meter
+AUTO_SEGMENT_METERS = 1.0
+
+# Project entries
+PROJECT_SCOPE = "autocurve"
+HARMONIZED_LAYERS_KEY = "harmonized_layers"
 
 
 def distance():
@@ -14,6 +40,116 @@ def angle():
     return float(QgsSettings().value(ANGLE_KEY, 1e-6))
 
 
+def auto_tolerances_enabled():
+    """Whether tolerances are derived from each layer instead of the settings"""
+    return QgsSettings().value(AUTO_TOLERANCES_KEY, None) == "true"
+
+
+def delay():
+    """Idle time in milliseconds to wait for after edits before post-processing them"""
+    return int(QgsSettings().value(DELAY_KEY, 0))
+
+
+def background_threshold():
+    """Number of changed features from which post-processing runs in the background"""
+    return int(QgsSettings().value(BACKGROUND_THRESHOLD_KEY, 500))
+
+
+def cache_size():
+    """Maximum number of features per layer for which snap points are kept in cache,
+    and from which arc indexes are rebuilt"""
+    return int(QgsSettings().value(CACHE_SIZE_KEY, 10000))
+
+
+def profiling_enabled():
+    return QgsSettings().value(PROFILING_ENABLED_KEY, None) == "true"
+
+
+def profiling_trace():
+    """Path of the file to append profiling results to, if any"""
+    return QgsSettings().value(PROFILING_TRACE_KEY, None) or None
+
+
+class Tolerances(NamedTuple):
+    """Immutable snapshot of the tolerance settings, with the angle in degrees"""
+
+    distance: float
+    angle: float
+
+
+_tolerances = None
+_layer_tolerances: Dict[str, Tolerances] = {}
+
+
+def tolerances() -> Tolerances:
+    """Returns the tolerances, read once from the settings and cached until invalidated"""
+    global _tolerances
+    if _tolerances is None:
+        _tolerances = Tolerances(distance=distance(), angle=angle())
+    return _tolerances
+
+
+def layer_tolerances(layer) -> Tolerances:
+    """Returns the tolerances to post-process the layer with.
+
+    In auto mode, they are derived from the layer and cached until invalidated,
+    otherwise they are the ones of the settings.
+    """
+
+    if not auto_tolerances_enabled():
+        return tolerances()
+
+    derived = _layer_tolerances.get(layer.id())
+    if derived is None:
+        derived = auto_tolerances(
+            layer.extent(),
+            layer.crs(),
+            layer.geometryOptions().geometryPrecision(),
+        )
+        _layer_tolerances[layer.id()] = derived
+    return derived
+
+
+def auto_tolerances(
+    extent: QgsRectangle, crs: QgsCoordinateReferenceSystem, precision: float = 0
+) -> Tolerances:
+    """Derives tolerances from the extent, the units of the CRS and the precision of
+    a layer, so that curves are detected whatever the magnitude of the coordinates,
+    while keeping the distance (thus the cells of the arc index) small."""
+
+    meter = 1.0
+    if crs.isValid():
+        meter = QgsUnitTypes.fromUnitToUnitFactor(
+            QgsUnitTypes.DistanceMeters, crs.mapUnits()
+        )
+
+    magnitude = 0.0
+    if not extent.isNull():
+        magnitude = max(
+            abs(extent.xMinimum()),
+            abs(extent.xMaximum()),
+            abs(extent.yMinimum()),
+            abs(extent.yMaximum()),
+        )
+
+    distance = max(
+        AUTO_DISTANCE_METERS * meter,
+        magnitude * AUTO_RELATIVE_PRECISION,
+        # Vertices snapped to the precision grid move by up to half of it
+        precision / 2,
+    )
+    # Rounding coordinates by the distance changes the direction of short segments
+    angle = math.degrees(distance / (AUTO_SEGMENT_METERS * meter))
+    return Tolerances(distance=distance, angle=angle)
+
+
+def invalidate():
+    """Discards cached settings, must be called when settings may have changed"""
+    global _tolerances
+    _tolerances = None
+    _layer_tolerances.clear()
+
+
 def autocurve_enabled():
     return QgsSettings().value(CURVIFY_ENABLED_KEY, None) == "true"
 
@@ -28,3 +164,17 @@ def harmonize_enabled():
 
 def set_harmonize_enabled(value):
     QgsSettings().setValue(HARMONIZE_ENABLED_KEY, str(value).lower())
+
+
+def harmonized_layer_ids() -> List[str]:
+    """Ids of the layers whose arcs are harmonized with each other, stored in the project"""
+    layer_ids, _ = QgsProject.instance().readListEntry(
+        PROJECT_SCOPE, HARMONIZED_LAYERS_KEY
+    )
+    return layer_ids
+
+
+def set_harmonized_layer_ids(layer_ids):
+    QgsProject.instance().writeEntry(
+        PROJECT_SCOPE, HARMONIZED_LAYERS_KEY, list(layer_ids)
+    )
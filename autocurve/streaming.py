@@ -0,0 +1,159 @@
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional
+
+from qgis.core import QgsFeature, QgsFeatureRequest, QgsGeometry, QgsRectangle
+
+from . import settings
+from .utils import Feedback, MiniIndex, SnapPointsCache, apply_moves, match_arcs
+
+DEFAULT_CHUNK_SIZE = 1000
+# Number of features whose arcs are kept in memory from one chunk to the next
+DEFAULT_WINDOW_SIZE = 20000
+
+# Resolution of the Hilbert curve ordering the features, in bits per axis
+_CURVE_BITS = 16
+_FID_MASK = (1 << 64) - 1
+
+# Transforms geometries by feature id, returning only the ones that changed
+Transform = Callable[[Dict[int, QgsGeometry]], Dict[int, QgsGeometry]]
+
+
+class Chunk(NamedTuple):
+    """Features of a chunk, with the number of them changed by each step"""
+
+    features: List[QgsFeature]
+    transformed: int
+    harmonized: int
+
+
+def harmonize_chunks(
+    source,
+    tolerance: Optional[float] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    window_size: int = DEFAULT_WINDOW_SIZE,
+    transform: Optional[Transform] = None,
+    feedback: Optional[Feedback] = None,
+) -> Iterator[Chunk]:
+    """Yields all features of the source with harmonized arcs, chunk by chunk.
+
+    Chunks follow a Hilbert curve of the bounding box centers, so that consecutive
+    chunks share most of their neighbours. Only the arcs of the last `window_size`
+    features read are kept from one chunk to the next, and besides the ordered feature
+    ids, memory doesn't depend on the size of the source.
+
+    The optional transform is applied to all geometries before harmonizing them (e.g.
+    to curvify them).
+    """
+
+    if tolerance is None:
+        tolerance = settings.distance()
+
+    order = spatial_order(source)
+    window = SnapPointsCache(max_size=window_size)
+
+    for start in range(0, len(order), chunk_size):
+        if feedback is not None:
+            if feedback.isCanceled():
+                return
+            feedback.setProgress(100 * start / len(order))
+
+        request = QgsFeatureRequest().setFilterFids(order[start : start + chunk_size])
+        features = list(source.getFeatures(request))
+        geometries = {feature.id(): feature.geometry() for feature in features}
+        transformed = transform(geometries) if transform is not None else {}
+        geometries.update(transformed)
+
+        # Arcs of the chunk, and the extent in which they can find arcs to snap to
+        snap_points = []
+        extent = QgsRectangle()
+        extent.setMinimal()
+        for fid, geometry in geometries.items():
+            # If already read as a neighbour, the window holds the transformed arcs
+            chunk_snap_points = window.get(fid, geometry)
+            if chunk_snap_points:
+                snap_points.extend(chunk_snap_points)
+                extent.combineExtentWith(geometry.boundingBox())
+
+        new_geoms = {}
+        if snap_points:
+            extent.grow(tolerance)
+            index = MiniIndex(tolerance)
+            index.add_snap_points(snap_points)
+
+            # Neighbours are read without attributes, most of them are in the window
+            candidates = set(geometries)
+            request = QgsFeatureRequest().setFilterRect(extent).setNoAttributes()
+            for feature in source.getFeatures(request):
+                fid = feature.id()
+                if fid in candidates:
+                    continue
+                candidates.add(fid)
+                geometry = feature.geometry()
+                if transform is not None and fid not in window:
+                    geometry = transform({fid: geometry}).get(fid, geometry)
+                index.add_snap_points(window.get(fid, geometry))
+
+            # All features are harmonized, so arcs only snap from lower to higher ids
+            moves = match_arcs(snap_points, index, tolerance, fids=candidates)
+            new_geoms = apply_moves(geometries, moves)
+
+            # Later chunks must see the harmonized arcs
+            for fid, new_geom in new_geoms.items():
+                window.invalidate(fid)
+                window.get(fid, new_geom)
+
+        for feature in features:
+            new_geom = new_geoms.get(feature.id())
+            if new_geom is None:
+                new_geom = transformed.get(feature.id())
+            if new_geom is not None:
+                feature.setGeometry(new_geom)
+
+        yield Chunk(features, len(transformed), len(new_geoms))
+
+
+def spatial_order(source) -> List[int]:
+    """Returns the ids of the features of the source along a Hilbert curve of their
+    bounding box centers"""
+
+    extent = source.sourceExtent()
+    scale = (1 << _CURVE_BITS) - 1
+    x_scale = scale / (extent.width() or 1)
+    y_scale = scale / (extent.height() or 1)
+
+    # Keys pack the curve distance and the feature id in a single int, to stay compact
+    keys = []
+    for feature in source.getFeatures(QgsFeatureRequest().setNoAttributes()):
+        geometry = feature.geometry()
+        distance = 0
+        if not geometry.isNull():
+            center = geometry.boundingBox().center()
+            x = int((center.x() - extent.xMinimum()) * x_scale)
+            y = int((center.y() - extent.yMinimum()) * y_scale)
+            distance = _hilbert_distance(min(max(x, 0), scale), min(max(y, 0), scale))
+        keys.append((distance << 64) | (feature.id() & _FID_MASK))
+
+    keys.sort()
+    for i, key in enumerate(keys):
+        fid = key & _FID_MASK
+        keys[i] = fid - (1 << 64) if fid >> 63 else fid
+    return keys
+
+
+def _hilbert_distance(x: int, y: int) -> int:
+    """Returns the distance of the cell (x, y) along the Hilbert curve"""
+
+    n = 1 << _CURVE_BITS
+    distance = 0
+    s = n >> 1
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        distance += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant so that the curve is continuous
+        if ry == 0:
+            if rx == 1:
+                x = n - 1 - x
+                y = n - 1 - y
+            x, y = y, x
+        s >>= 1
+    return distance
@@ -0,0 +1,93 @@
+from typing import Dict, Optional
+
+from qgis.core import QgsGeometry, QgsTask
+
+from .settings import Tolerances
+from .utils import MiniIndex, curvify_geometries, get_snap_points, harmonize_geometries
+
+
+class _TaskStep:
+    """Feedback-like helper reporting the progress of one step of a task"""
+
+    def __init__(self, task: QgsTask, start: float, end: float):
+        self.task = task
+        self.start = start
+        self.end = end
+
+    def isCanceled(self):
+        return self.task.isCanceled()
+
+    def setProgress(self, progress):
+        self.task.setProgress(self.start + progress * (self.end - self.start) / 100)
+
+
+class PostProcessTask(QgsTask):
+    """Computes curvified and harmonized geometries in the background.
+
+    The task works on detached copies of the geometries and never touches the layer,
+    the resulting `new_geoms` are to be applied from the main thread once finished.
+    The index is owned by the task too, holding the arcs of the neighbours only: the
+    ones of the given features are added once curvified.
+    """
+
+    def __init__(
+        self,
+        layer,
+        geometries: Dict[int, QgsGeometry],
+        tolerances: Tolerances,
+        curvify: bool,
+        index: Optional[MiniIndex],
+        on_finished,
+    ):
+        super().__init__("Autocurve", QgsTask.CanCancel)
+        self.layer = layer
+        self.layer_id = layer.id()
+        self.original_wkbs = {fid: geom.asWkb() for fid, geom in geometries.items()}
+        self.geometries = {
+            fid: QgsGeometry(geom.constGet().clone())
+            for fid, geom in geometries.items()
+            if not geom.isNull()
+        }
+        self.tolerances = tolerances
+        self.curvify = curvify
+        self.index = index
+        self.on_finished = on_finished
+        self.new_geoms: Dict[int, QgsGeometry] = {}
+        # Set from the worker thread, as the status only changes once the main thread
+        # handled the completion, which it can't while waiting for the task
+        self.completed = False
+
+    def run(self):
+        geometries = self.geometries
+
+        if self.curvify:
+            self.new_geoms.update(
+                curvify_geometries(
+                    geometries,
+                    self.tolerances.distance,
+                    self.tolerances.angle,
+                    feedback=_TaskStep(self, 0, 50),
+                )
+            )
+            geometries = {**geometries, **self.new_geoms}
+
+        if self.index is not None:
+            # The features must also be matched with each other, e.g. after a paste
+            for fid, geometry in geometries.items():
+                self.index.add_snap_points(
+                    get_snap_points(fid, geometry, self.layer_id)
+                )
+            self.new_geoms.update(
+                harmonize_geometries(
+                    geometries,
+                    self.index,
+                    feedback=_TaskStep(self, 50, 100),
+                    layer_id=self.layer_id,
+                )
+            )
+
+        self.completed = not self.isCanceled()
+        return self.completed
+
+    def finished(self, result):
+        self.on_finished(self)
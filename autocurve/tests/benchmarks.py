@@ -0,0 +1,208 @@
+"""
+Benchmarks of the post-processing stages on generated layers, runs without QGIS desktop.
+
+    python3 -m autocurve.tests.benchmarks
+
+Layers are made of "half suns" (a half disk whose arcs are each shared with a neighbour,
+with a different arc center) repeated on a grid, parametrized by the environment:
+
+- AUTOCURVE_BENCHMARK_SIZES: comma separated feature counts (default 1000,10000,100000)
+- AUTOCURVE_BENCHMARK_STEPS: comma separated arc sizes in degrees (default 1,10)
+- AUTOCURVE_BENCHMARK_OFFSETS: comma separated coordinates offsets (default 0,2600000)
+- AUTOCURVE_BENCHMARK_OUTPUT: path of the JSON results (default benchmark.json)
+"""
+
+import configparser
+import itertools
+import json
+import math
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from qgis.core import (
+    Qgis,
+    QgsApplication,
+    QgsFeature,
+    QgsFeatureRequest,
+    QgsGeometry,
+    QgsVectorLayer,
+)
+
+from autocurve.tests.helpers import segmented_arc, vtx_at_angle
+from autocurve.utils import (
+    MiniIndex,
+    curvify_geometries,
+    get_snap_points,
+    harmonize_geometries,
+    match_arcs,
+)
+
+TOLERANCE = 1e-6
+
+
+def _env_list(name, default):
+    return [int(value) for value in os.environ.get(name, default).split(",")]
+
+
+def half_sun(step, center):
+    """Returns the WKT of a half sun and of its neighbours"""
+
+    cx, cy = center
+    polygon_part = []
+    neighbours = []
+    for a in range(0, 180, step):
+        polygon_part.append(
+            f"CIRCULARSTRING({vtx_at_angle(a, 1, center)}, {vtx_at_angle(a+2/3*step, 1, center)}, {vtx_at_angle(a+step, 1, center)})"
+        )
+        neighbours.append(
+            f"CURVEPOLYGON(COMPOUNDCURVE(({vtx_at_angle(a, 2, center)}, {vtx_at_angle(a, 1, center)}), CIRCULARSTRING({vtx_at_angle(a, 1, center)}, {vtx_at_angle(a+1/3*step, 1, center)}, {vtx_at_angle(a+step, 1, center)}), ({vtx_at_angle(a+step, 1, center)}, {vtx_at_angle(a+step, 2, center)}, {vtx_at_angle(a, 2, center)})))"
+        )
+    sun = f"CURVEPOLYGON(COMPOUNDCURVE(({cx} {cy}, {cx+1} {cy}), {','.join(polygon_part)}, ({cx-1} {cy}, {cx} {cy})))"
+    return [sun, *neighbours]
+
+
+def segmented_half_sun(center):
+    """Returns the WKT of a half sun whose arc is segmented"""
+
+    cx, cy = center
+    return f"POLYGON(({cx} {cy}, {segmented_arc(0, 180, 1, 1, center)}, {cx} {cy}))"
+
+
+def make_layer(wkt_geoms, geom_type="curvepolygon") -> QgsVectorLayer:
+    """Returns a memory layer with the given geometries"""
+
+    vl = QgsVectorLayer(f"{geom_type}?crs=epsg:2056", "benchmark", "memory")
+    features = []
+    for wkt_geom in wkt_geoms:
+        feat = QgsFeature()
+        feat.setGeometry(QgsGeometry.fromWkt(wkt_geom))
+        features.append(feat)
+    vl.dataProvider().addFeatures(features)
+    return vl
+
+
+def make_layers(size, step, offset):
+    """Returns a curved layer of about `size` features and a segmented one"""
+
+    features_per_sun = 1 + math.ceil(180 / step)
+    suns = math.ceil(size / features_per_sun)
+    columns = math.ceil(math.sqrt(suns))
+    centers = [
+        (offset + 5 * (i % columns), offset + 5 * (i // columns)) for i in range(suns)
+    ]
+
+    curved = make_layer(
+        itertools.islice(
+            itertools.chain.from_iterable(half_sun(step, c) for c in centers), size
+        )
+    )
+    segmented = make_layer((segmented_half_sun(c) for c in centers), "polygon")
+    return curved, segmented
+
+
+def _geometries(layer):
+    request = QgsFeatureRequest().setNoAttributes()
+    return {feature.id(): feature.geometry() for feature in layer.getFeatures(request)}
+
+
+@contextmanager
+def _timer(timings, stage):
+    start = time.perf_counter()
+    yield
+    timings[stage] = time.perf_counter() - start
+
+
+def run(size, step, offset):
+    """Times each stage separately on the given configuration"""
+
+    curved, segmented = make_layers(size, step, offset)
+    geometries = _geometries(curved)
+    segmented_geometries = _geometries(segmented)
+
+    timings = {}
+    with _timer(timings, "get_snap_points"):
+        snap_points = [
+            snap_point
+            for fid, geometry in geometries.items()
+            for snap_point in get_snap_points(fid, geometry)
+        ]
+
+    with _timer(timings, "index_build"):
+        index = MiniIndex(TOLERANCE)
+        index.add_snap_points(snap_points)
+
+    with _timer(timings, "index_query"):
+        neighbours = index.get_neighbours_bulk(snap_points)
+
+    with _timer(timings, "snaps_to"):
+        snaps = sum(
+            snap_point.snaps_to(other, TOLERANCE)
+            for snap_point, candidates in zip(snap_points, neighbours)
+            for other in candidates
+        )
+
+    with _timer(timings, "match_arcs"):
+        matches = match_arcs(snap_points, index, TOLERANCE)
+
+    with _timer(timings, "curvify"):
+        curvified = curvify_geometries(segmented_geometries, TOLERANCE, TOLERANCE)
+
+    with _timer(timings, "harmonize"):
+        harmonized = harmonize_geometries(geometries, index)
+
+    return {
+        "features": len(geometries),
+        "step": step,
+        "offset": offset,
+        "timings": timings,
+        "counts": {
+            "arcs": len(snap_points),
+            "candidates": sum(len(candidates) for candidates in neighbours),
+            "snaps": snaps,
+            "matches": len(matches),
+            "curvified": len(curvified),
+            "harmonized": len(harmonized),
+        },
+    }
+
+
+def _plugin_version():
+    metadata = configparser.ConfigParser()
+    metadata.read(Path(__file__).parent.parent / "metadata.txt")
+    return metadata["general"]["version"]
+
+
+def main():
+    app = QgsApplication([], False)
+    app.initQgis()
+
+    results = []
+    for size, step, offset in itertools.product(
+        _env_list("AUTOCURVE_BENCHMARK_SIZES", "1000,10000,100000"),
+        _env_list("AUTOCURVE_BENCHMARK_STEPS", "1,10"),
+        _env_list("AUTOCURVE_BENCHMARK_OFFSETS", "0,2600000"),
+    ):
+        result = run(size, step, offset)
+        print(f"{size} features, {step}° arcs, offset {offset}: {result['timings']}")
+        results.append(result)
+
+    output = os.environ.get("AUTOCURVE_BENCHMARK_OUTPUT", "benchmark.json")
+    with open(output, "w") as f:
+        json.dump(
+            {
+                "qgis_version": Qgis.QGIS_VERSION,
+                "plugin_version": _plugin_version(),
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    print(f"Results written to {output}")
+
+    app.exitQgis()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,15 @@
+import math
+
+
+def segmented_arc(from_angle, to_angle, step, radius=1, center=(0, 0)) -> str:
+    """Helper that returns a segmented arc (list of vertex) at given angle on a circle in WKT notation"""
+    return ",".join(
+        vtx_at_angle(a, radius, center)
+        for a in range(from_angle, to_angle + step, step)
+    )
+
+
+def vtx_at_angle(angle, radius=1, center=(0, 0)) -> str:
+    """Helper that returns a vertex at given angle on a circle (by default the unit circle) in WKT notation"""
+    angle = angle % 360
+    return f"{center[0] + radius*math.cos(math.radians(angle))} {center[1] + radius*math.sin(math.radians(angle))}"
@@ -1,17 +1,26 @@
+import json
 import math
 import os
+import tempfile
 import timeit
 from datetime import datetime
 from pathlib import Path
 from random import uniform
+from typing import List
+from unittest import mock
 
 from qgis.core import (
     QgsApplication,
+    QgsCoordinateReferenceSystem,
     QgsFeature,
     QgsGeometry,
+    QgsGeometryUtils,
     QgsPointXY,
     QgsProject,
+    QgsRectangle,
+    QgsSettings,
     QgsSnappingConfig,
+    QgsVectorFileWriter,
     QgsVectorLayer,
 )
 from qgis.gui import QgsMapCanvasTracer, QgsMapMouseEvent
@@ -19,6 +28,15 @@ from qgis.PyQt.QtCore import QEvent, QPoint, Qt
 from qgis.testing import unittest
 from qgis.utils import iface, plugins
 
+from autocurve import settings
+from autocurve.batch import harmonize_layer
+from autocurve.cli import main, open_layer, process_file
+from autocurve.profiling import TRACE_MAX_SIZE, Profiler
+from autocurve.settings import Tolerances
+from autocurve.streaming import harmonize_chunks, spatial_order
+from autocurve.tests.helpers import segmented_arc, vtx_at_angle
+from autocurve.utils import LayerArcIndex, get_snap_points, has_curves
+
 VISUAL_FEEDBACK = os.environ.get("AUTOCURVE_VISUAL_FEEDBACK") == "true"
 
 
@@ -65,14 +83,11 @@ class IntegrationTest(unittest.TestCase):
 
     def _segmented_arc(self, from_angle, to_angle, step):
         """Helper that returns a segmented arc (list of vertex) at given angle on the unit circle in WKT notation"""
-        return ",".join(
-            self._vtx_at_angle(a) for a in range(from_angle, to_angle + step, step)
-        )
+        return segmented_arc(from_angle, to_angle, step)
 
     def _vtx_at_angle(self, angle: int, radius=1) -> str:
         """Helper that returns a vertex at given angle on the unit circle in WKT notation"""
-        angle = angle % 360
-        return f"{radius*math.cos(math.radians(angle))} {radius*math.sin(math.radians(angle))}"
+        return vtx_at_angle(angle, radius)
 
     def _make_layer(self, wkt_geoms, geom_type="curvepolygon") -> QgsVectorLayer:
         """Helper that adds a styled vector layer with the given geometries to the project and returns it"""
@@ -88,18 +103,24 @@ class IntegrationTest(unittest.TestCase):
         QgsProject.instance().addMapLayer(vl)
         return vl
 
+    def _shared_arc_wkts(self) -> List[str]:
+        """Helper that returns two shapes having a common arc with a different center point"""
+        return [
+            f"CURVEPOLYGON( COMPOUNDCURVE( (0 0, 0 1), CIRCULARSTRING(0 1, {self._vtx_at_angle(30)}, 1 0), (1 0, 0 0) ) )",
+            f"CURVEPOLYGON( COMPOUNDCURVE( (1 1, 0 1), CIRCULARSTRING(0 1, {self._vtx_at_angle(60)}, 1 0), (1 0, 1 1) ) )",
+        ]
+
+    def _shared_arc_layer(self) -> QgsVectorLayer:
+        """Helper that adds a layer with two shapes having a common arc with a different center point"""
+        return self._make_layer(self._shared_arc_wkts())
+
     def test_center_points(self):
         # Disable the actions
         plugins["autocurve"].auto_curve_action.setChecked(False)
         plugins["autocurve"].harmonize_arcs_action.setChecked(False)
 
         # Create two shapes that have a common arc with a different center point
-        vl = self._make_layer(
-            [
-                f"CURVEPOLYGON( COMPOUNDCURVE( (0 0, 0 1), CIRCULARSTRING(0 1, {self._vtx_at_angle(30)}, 1 0), (1 0, 0 0) ) )",
-                f"CURVEPOLYGON( COMPOUNDCURVE( (1 1, 0 1), CIRCULARSTRING(0 1, {self._vtx_at_angle(60)}, 1 0), (1 0, 1 1) ) )",
-            ],
-        )
+        vl = self._shared_arc_layer()
 
         self.feedback()
 
@@ -135,6 +156,607 @@ class IntegrationTest(unittest.TestCase):
             vl.getFeature(2).geometry().vertexAt(2),
         )
 
+    def test_center_points_after_neighbour_change(self):
+        plugin = plugins["autocurve"]
+        # Enable the actions, autocurve keeps the plugin watching the edits throughout
+        plugin.auto_curve_action.setChecked(True)
+        plugin.harmonize_arcs_action.setChecked(True)
+
+        # Create two shapes that have a common arc with a different center point
+        vl = self._shared_arc_layer()
+        iface.setActiveLayer(vl)
+        vl.startEditing()
+
+        # A first edit builds the arc index
+        self._move_vertex(vl, feat_id=1, vtx_id=0, x=-0.1, y=-0.1, toggle_editing=False)
+        index = plugin.arc_indexes[frozenset([vl.id()])]
+
+        self.feedback()
+
+        # Move the center point of the neighbour with harmonize_arcs disabled
+        plugin.harmonize_arcs_action.setChecked(False)
+        angle = math.radians(45)
+        self._move_vertex(
+            vl,
+            feat_id=2,
+            vtx_id=2,
+            x=math.cos(angle),
+            y=math.sin(angle),
+            toggle_editing=False,
+        )
+
+        self.feedback()
+
+        # Edit the first feature with harmonize_arcs enabled
+        plugin.harmonize_arcs_action.setChecked(True)
+        self._move_vertex(vl, feat_id=1, vtx_id=0, x=-0.2, y=-0.2, toggle_editing=False)
+
+        # The index followed the neighbour change instead of being rebuilt
+        self.assertIs(plugin.arc_indexes[frozenset([vl.id()])], index)
+        vl.commitChanges()
+
+        self.feedback()
+
+        # The center point should match the moved one
+        self.assertEqual(
+            vl.getFeature(1).geometry().vertexAt(2),
+            vl.getFeature(2).geometry().vertexAt(2),
+        )
+
+    def test_selection_is_kept(self):
+        # Enable the actions
+        plugins["autocurve"].auto_curve_action.setChecked(True)
+        plugins["autocurve"].harmonize_arcs_action.setChecked(True)
+
+        # Create two shapes that have a common arc with a different center point
+        vl = self._shared_arc_layer()
+        iface.setActiveLayer(vl)
+
+        # Select the second feature and edit the first one
+        vl.selectByIds([2])
+        self._move_vertex(vl, feat_id=1, vtx_id=0, x=-0.1, y=-0.1)
+
+        self.feedback()
+
+        # The edit was post-processed
+        self.assertEqual(
+            vl.getFeature(1).geometry().vertexAt(2),
+            vl.getFeature(2).geometry().vertexAt(2),
+        )
+
+        # The selection is unchanged
+        self.assertEqual(vl.selectedFeatureIds(), [2])
+
+    def test_center_points_across_layers(self):
+        # Enable harmonize only
+        plugins["autocurve"].auto_curve_action.setChecked(False)
+        plugins["autocurve"].harmonize_arcs_action.setChecked(True)
+
+        # Create two layers with shapes that have a common arc with a different center point
+        vl1, vl2 = [self._make_layer([wkt]) for wkt in self._shared_arc_wkts()]
+        plugins["autocurve"].set_harmonized_layers([vl1, vl2])
+
+        # Edit the layer that is not the active one
+        iface.setActiveLayer(vl1)
+        self._move_vertex(vl2, feat_id=1, vtx_id=0, x=1.1, y=1.1)
+
+        self.feedback()
+
+        # The center point of the edited layer should match the other layer
+        self.assertEqual(
+            vl1.getFeature(1).geometry().vertexAt(2),
+            vl2.getFeature(1).geometry().vertexAt(2),
+        )
+
+        plugins["autocurve"].set_harmonized_layers([])
+
+    def test_delayed_post_processing(self):
+        plugin = plugins["autocurve"]
+        plugin.auto_curve_action.setChecked(False)
+        plugin.harmonize_arcs_action.setChecked(True)
+
+        QgsSettings().setValue(settings.DELAY_KEY, 60000)
+        try:
+            # Pending changes are processed before being committed
+            vl = self._shared_arc_layer()
+            vl.startEditing()
+            self._move_vertex(vl, 1, 0, -0.1, -0.1, toggle_editing=False)
+            self.feedback()
+            self.assertNotEqual(
+                vl.getFeature(1).geometry().vertexAt(2),
+                vl.getFeature(2).geometry().vertexAt(2),
+            )
+            self.assertTrue(vl.commitChanges())
+            self.assertEqual(
+                vl.getFeature(1).geometry().vertexAt(2),
+                vl.getFeature(2).geometry().vertexAt(2),
+            )
+
+            # Consecutive edit commands are processed at once when editing pauses
+            QgsSettings().setValue(settings.DELAY_KEY, 100)
+            vl = self._shared_arc_layer()
+            vl.startEditing()
+            self._move_vertex(vl, 1, 0, -0.1, -0.1, toggle_editing=False)
+            self._move_vertex(vl, 1, 0, -0.2, -0.2, toggle_editing=False)
+            self.assertTrue(plugin.post_process_timer.isActive())
+            self.assertEqual(vl.undoStack().count(), 2)
+
+            start = datetime.now()
+            while plugin.post_process_timer.isActive():
+                self.assertLess((datetime.now() - start).total_seconds(), 5)
+                QgsApplication.processEvents()
+
+            self.assertEqual(vl.undoStack().count(), 3)
+            self.assertEqual(vl.undoStack().text(2), "Harmonize arcs")
+            self.assertEqual(
+                vl.getFeature(1).geometry().vertexAt(2),
+                vl.getFeature(2).geometry().vertexAt(2),
+            )
+
+            # Pending changes are dropped on rollback
+            self._move_vertex(vl, 1, 0, -0.3, -0.3, toggle_editing=False)
+            self.assertIn(vl, plugin.pending_fids)
+            vl.rollBack()
+            self.assertNotIn(vl, plugin.pending_fids)
+            self.assertFalse(plugin.post_process_timer.isActive())
+        finally:
+            QgsSettings().remove(settings.DELAY_KEY)
+
+    def test_commit_while_post_processing_in_background(self):
+        plugin = plugins["autocurve"]
+        plugin.auto_curve_action.setChecked(False)
+        plugin.harmonize_arcs_action.setChecked(True)
+
+        vl = self._shared_arc_layer()
+
+        QgsSettings().setValue(settings.BACKGROUND_THRESHOLD_KEY, 1)
+        try:
+            vl.startEditing()
+            self._move_vertex(vl, 1, 0, -0.1, -0.1, toggle_editing=False)
+            self.assertIsNotNone(plugin.task)
+
+            # Committing waits for the task, whose results are committed too
+            self.assertTrue(vl.commitChanges())
+            self.assertIsNone(plugin.task)
+            self.assertEqual(
+                vl.getFeature(1).geometry().vertexAt(2),
+                vl.getFeature(2).geometry().vertexAt(2),
+            )
+        finally:
+            QgsSettings().remove(settings.BACKGROUND_THRESHOLD_KEY)
+
+    def test_paste_in_background(self):
+        plugin = plugins["autocurve"]
+        plugin.auto_curve_action.setChecked(True)
+        plugin.harmonize_arcs_action.setChecked(True)
+
+        vl = self._make_layer([])
+
+        # Two segmented features sharing an arc, segmented differently
+        features = []
+        for wkt_geom in [
+            f"POLYGON(( 0 0, {self._segmented_arc(0, 90, 1)}, 0 0 ))",
+            f"POLYGON(( 1 1, {self._segmented_arc(0, 90, 2)}, 1 1 ))",
+        ]:
+            feature = QgsFeature(vl.fields())
+            feature.setGeometry(QgsGeometry.fromWkt(wkt_geom))
+            features.append(feature)
+
+        QgsSettings().setValue(settings.BACKGROUND_THRESHOLD_KEY, 1)
+        try:
+            vl.startEditing()
+            vl.beginEditCommand("paste")
+            vl.addFeatures(features)
+            vl.endEditCommand()
+            self.assertIsNotNone(plugin.task)
+            self.assertTrue(vl.commitChanges())
+        finally:
+            QgsSettings().remove(settings.BACKGROUND_THRESHOLD_KEY)
+
+        # Pasted features are harmonized with each other, like in the foreground
+        geometries = [feature.geometry() for feature in vl.getFeatures()]
+        self.assertEqual(len(get_snap_points(1, geometries[0])), 1)
+        self.assertEqual(geometries[0].vertexAt(2), geometries[1].vertexAt(2))
+
+    def test_harmonize_in_one_command(self):
+        plugin = plugins["autocurve"]
+        plugin.auto_curve_action.setChecked(False)
+        plugin.harmonize_arcs_action.setChecked(True)
+
+        vl = self._make_layer(
+            [
+                *self._shared_arc_wkts(),
+                f"CURVEPOLYGON( COMPOUNDCURVE( (1 1, 0 1), CIRCULARSTRING(0 1, {self._vtx_at_angle(45)}, 1 0), (1 0, 1 1) ) )",
+            ]
+        )
+        center = vl.getFeature(1).geometry().vertexAt(2)
+        vl.startEditing()
+
+        # Record whether features get reindexed while our changes are being applied
+        reindexed_while_applying = []
+        set_snap_points = LayerArcIndex.set_snap_points
+
+        def recording_set_snap_points(index, *args, **kwargs):
+            reindexed_while_applying.append(plugin._applying_geometries)
+            set_snap_points(index, *args, **kwargs)
+
+        # Edit two features in a single command
+        with mock.patch.object(
+            LayerArcIndex, "set_snap_points", recording_set_snap_points
+        ):
+            vl.beginEditCommand("moving vertices")
+            vl.moveVertex(-0.1, -0.1, 1, 0)
+            vl.moveVertex(1.1, 1.1, 2, 0)
+            vl.endEditCommand()
+
+        self.feedback()
+
+        # Both features were harmonized by one more command
+        self.assertEqual(vl.undoStack().count(), 2)
+        self.assertEqual(vl.undoStack().text(1), "Harmonize arcs")
+        self.assertEqual(
+            vl.getFeature(2).geometry().vertexAt(2),
+            vl.getFeature(3).geometry().vertexAt(2),
+        )
+        self.assertNotEqual(vl.getFeature(1).geometry().vertexAt(2), center)
+
+        # Changes were reindexed at once afterwards, matching the new geometries
+        self.assertIn(False, reindexed_while_applying)
+        self.assertNotIn(True, reindexed_while_applying)
+        index = plugin.arc_indexes[frozenset([vl.id()])]
+        for fid in (1, 2, 3):
+            self.assertEqual(
+                [sp.mid for sp in index.snap_points_by_fid[(vl.id(), fid)]],
+                [sp.mid for sp in get_snap_points(fid, vl.getFeature(fid).geometry())],
+            )
+
+        vl.commitChanges()
+
+    def test_arc_index_is_bounded(self):
+        plugin = plugins["autocurve"]
+        plugin.auto_curve_action.setChecked(False)
+        plugin.harmonize_arcs_action.setChecked(True)
+
+        vl = self._make_layer(
+            [
+                self._shared_arc_wkts()[0],
+                f"CURVEPOLYGON( COMPOUNDCURVE( (100 0, 100 1), CIRCULARSTRING(100 1, {vtx_at_angle(30, center=(100, 0))}, 101 0), (101 0, 100 0) ) )",
+            ],
+        )
+
+        QgsSettings().setValue(settings.CACHE_SIZE_KEY, 1)
+        try:
+            vl.startEditing()
+            self._move_vertex(vl, 1, 0, -0.1, -0.1, toggle_editing=False)
+            index = plugin.arc_indexes[frozenset([vl.id()])]
+            self.assertTrue(index.has_feature(1, vl.id()))
+
+            # Edits elsewhere fill the index, until it's rebuilt around them
+            self._move_vertex(vl, 2, 0, 99.9, -0.1, toggle_editing=False)
+            self._move_vertex(vl, 2, 0, 99.8, -0.1, toggle_editing=False)
+            index = plugin.arc_indexes[frozenset([vl.id()])]
+            self.assertTrue(index.has_feature(2, vl.id()))
+            self.assertFalse(index.has_feature(1, vl.id()))
+
+            # The index is dropped once editing stops
+            vl.commitChanges()
+            self.assertNotIn(frozenset([vl.id()]), plugin.arc_indexes)
+        finally:
+            QgsSettings().remove(settings.CACHE_SIZE_KEY)
+
+    def test_no_prefetch_without_arcs(self):
+        plugin = plugins["autocurve"]
+        plugin.auto_curve_action.setChecked(False)
+        plugin.harmonize_arcs_action.setChecked(True)
+
+        vl = self._make_layer(
+            [
+                self._shared_arc_wkts()[0],
+                "CURVEPOLYGON( COMPOUNDCURVE( (2 0, 2 1, 3 1, 3 0, 2 0) ) )",
+            ],
+        )
+
+        # A feature without geometry, e.g. added from the attribute table
+        vl.startEditing()
+        vl.beginEditCommand("add")
+        vl.addFeature(QgsFeature(vl.fields()))
+        vl.endEditCommand()
+
+        # And a feature without arcs
+        self._move_vertex(vl, 2, 0, 1.9, -0.1, toggle_editing=False)
+
+        # Neither reads neighbours
+        self.assertNotIn(frozenset([vl.id()]), plugin.arc_indexes)
+        vl.commitChanges()
+
+    def test_profiler(self):
+        profiler = Profiler()
+
+        # Nothing is collected unless profiling is enabled
+        profiler.start_run(False, layer="disabled")
+        with profiler.stage("index"):
+            profiler.count("changed")
+        self.assertFalse(profiler.active)
+        profiler.end_run()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            trace_path = os.path.join(tmp_dir, "trace.jsonl")
+
+            # Stages and counts are summed over the run
+            profiler.start_run(True, trace_path, layer="enabled")
+            run = profiler.current
+            for _ in range(2):
+                with profiler.stage("index"):
+                    profiler.count("changed", 2)
+            self.assertTrue(profiler.active)
+            self.assertEqual(list(run["stages"]), ["index"])
+            self.assertEqual(run["counts"], {"changed": 4})
+            profiler.end_run()
+            self.assertFalse(profiler.active)
+            self.assertRegex(
+                profiler.format_run(run),
+                r"^Post-processed in [\d.]+ ms \(index [\d.]+ ms\), changed 4$",
+            )
+
+            # Finished runs are appended to the trace
+            with open(trace_path) as f:
+                (line,) = f.readlines()
+            self.assertEqual(json.loads(line)["layer"], "enabled")
+            self.assertEqual(json.loads(line)["counts"], {"changed": 4})
+
+            # The trace is rolled over once it exceeds its maximum size
+            with open(trace_path, "a") as f:
+                f.write(" " * TRACE_MAX_SIZE + "\n")
+            profiler.start_run(True, trace_path, layer="rolled")
+            profiler.end_run()
+            self.assertGreater(os.path.getsize(f"{trace_path}.1"), TRACE_MAX_SIZE)
+            with open(trace_path) as f:
+                (line,) = f.readlines()
+            self.assertEqual(json.loads(line)["layer"], "rolled")
+
+    def test_profiling_trace(self):
+        plugins["autocurve"].auto_curve_action.setChecked(False)
+        plugins["autocurve"].harmonize_arcs_action.setChecked(True)
+
+        vl = self._shared_arc_layer()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            trace_path = os.path.join(tmp_dir, "trace.jsonl")
+            QgsSettings().setValue(settings.PROFILING_ENABLED_KEY, "true")
+            QgsSettings().setValue(settings.PROFILING_TRACE_KEY, trace_path)
+            try:
+                self._move_vertex(vl, feat_id=1, vtx_id=0, x=-0.1, y=-0.1)
+            finally:
+                QgsSettings().remove(settings.PROFILING_ENABLED_KEY)
+                QgsSettings().remove(settings.PROFILING_TRACE_KEY)
+
+            # The post-processing of the edit was traced as one JSON line
+            with open(trace_path) as f:
+                (line,) = f.readlines()
+            run = json.loads(line)
+            self.assertEqual(run["layer"], vl.name())
+            self.assertEqual(run["features"], 1)
+            self.assertIn("snap_points", run["stages"])
+            self.assertEqual(run["counts"]["changed"], 1)
+
+    def test_harmonize_layer(self):
+        # Create two shapes that have a common arc with a different center point
+        vl = self._shared_arc_layer()
+
+        new_geoms = harmonize_layer(vl, 1e-6, workers=2, tiles=2)
+
+        # Only one of the features is changed, and now matches the other
+        self.assertEqual(list(new_geoms.keys()), [1])
+        self.assertEqual(
+            new_geoms[1].vertexAt(2),
+            vl.getFeature(2).geometry().vertexAt(2),
+        )
+
+    def test_harmonize_chunks(self):
+        plugins["autocurve"].auto_curve_action.setChecked(False)
+        plugins["autocurve"].harmonize_arcs_action.setChecked(False)
+
+        def shared_arc_wkts(x):
+            # The shapes of _shared_arc_wkts, moved along the x axis
+            return [
+                f"CURVEPOLYGON( COMPOUNDCURVE( ({x} 0, {x} 1), CIRCULARSTRING({x} 1, {vtx_at_angle(30, center=(x, 0))}, {x + 1} 0), ({x + 1} 0, {x} 0) ) )",
+                f"CURVEPOLYGON( COMPOUNDCURVE( ({x + 1} 1, {x} 1), CIRCULARSTRING({x} 1, {vtx_at_angle(60, center=(x, 0))}, {x + 1} 0), ({x + 1} 0, {x + 1} 1) ) )",
+            ]
+
+        # Pairs of shapes with a common arc, the first shapes of all pairs added first
+        pairs = [shared_arc_wkts(x) for x in (0, 3, 6)]
+        vl = self._make_layer([pair[0] for pair in pairs] + [pair[1] for pair in pairs])
+
+        # And an uncommitted pair, with negative feature ids
+        vl.startEditing()
+        for wkt_geom in shared_arc_wkts(9):
+            feat = QgsFeature(vl.fields())
+            feat.setGeometry(QgsGeometry.fromWkt(wkt_geom))
+            vl.addFeature(feat)
+
+        fids = vl.allFeatureIds()
+        self.assertEqual(len([fid for fid in fids if fid < 0]), 2)
+        self.assertCountEqual(spatial_order(vl), fids)
+
+        # Neighbours are read from the source before their own chunk, and most are
+        # evicted from the window by the time their chunk comes
+        chunks = list(harmonize_chunks(vl, 1e-6, chunk_size=1, window_size=1))
+        self.assertEqual(len(chunks), len(fids))
+        streamed = {
+            feature.id(): feature.geometry()
+            for chunk in chunks
+            for feature in chunk.features
+        }
+        self.assertCountEqual(streamed, fids)
+
+        # The result is the same as when harmonizing the whole layer at once
+        expected = harmonize_layer(vl, 1e-6, workers=1)
+        self.assertEqual(len(expected), 4)
+        self.assertEqual(sum(chunk.harmonized for chunk in chunks), len(expected))
+        for fid, geometry in streamed.items():
+            self.assertEqual(
+                geometry.asWkt(),
+                expected.get(fid, vl.getFeature(fid).geometry()).asWkt(),
+            )
+
+        vl.rollBack()
+
+    def test_process_file(self):
+        # A segmented shape, and a neighbour with a common arc with another center point
+        vl = self._make_layer(
+            [
+                f"POLYGON(( 0 0, {self._segmented_arc(0, 90, 1)}, 0 0 ))",
+                f"CURVEPOLYGON( COMPOUNDCURVE( (1 1, 0 1), CIRCULARSTRING(0 1, {self._vtx_at_angle(60)}, 1 0), (1 0, 1 1) ) )",
+            ],
+        )
+
+        with tempfile.TemporaryDirectory() as directory:
+            input_path = os.path.join(directory, "input.gpkg")
+            output_path = os.path.join(directory, "output.gpkg")
+            QgsVectorFileWriter.writeAsVectorFormat(vl, input_path, "UTF-8")
+
+            stats = process_file(
+                input_path,
+                output_path,
+                tolerances=Tolerances(distance=1e-6, angle=1e-6),
+                chunk_size=1,
+            )
+
+            # All features are written, the segmented one is converted and snapped
+            self.assertEqual(stats.features, 2)
+            self.assertGreaterEqual(stats.curvified, 1)
+            self.assertEqual(stats.harmonized, 1)
+
+            output = open_layer(output_path)
+            geometries = [feature.geometry() for feature in output.getFeatures()]
+            self.assertEqual(geometries[0].vertexAt(2), geometries[1].vertexAt(2))
+            del output
+
+            with self.assertRaises(ValueError):
+                process_file(input_path, output_path, curvify=False, harmonize=False)
+
+            # The command line rejects tolerances the index can't work with
+            for distance in ("0", "-1"):
+                with self.assertRaises(SystemExit):
+                    main([input_path, output_path, "--distance", distance])
+
+    def test_has_curves(self):
+        # Straight features are told apart without walking their vertices
+        straight = QgsGeometry.fromWkt(
+            "CURVEPOLYGON( COMPOUNDCURVE( (0 0, 0 1, 1 1, 1 0, 0 0) ) )"
+        )
+        self.assertFalse(has_curves(straight))
+        self.assertEqual(get_snap_points(1, straight), [])
+        self.assertFalse(has_curves(QgsGeometry()))
+
+        curved = QgsGeometry.fromWkt(
+            f"CURVEPOLYGON( COMPOUNDCURVE( (0 0, 0 1), CIRCULARSTRING(0 1, {self._vtx_at_angle(30)}, 1 0), (1 0, 0 0) ) )"
+        )
+        self.assertTrue(has_curves(curved))
+        self.assertEqual(len(get_snap_points(1, curved)), 1)
+
+    def test_snap_points_match_qgis(self):
+        # The kernel reads arcs from WKB, vertex numbers and circles must match QGIS
+        geometry = QgsGeometry.fromWkt(
+            "MULTISURFACE Z("
+            "CURVEPOLYGON Z(COMPOUNDCURVE Z((0 0 1, 0 1 1), CIRCULARSTRING Z(0 1 1, 0.5 1.5 2, 1 1 1, 1.5 0.5 2, 1 0 1), (1 0 1, 0 0 1)),"
+            "CIRCULARSTRING Z(0.2 0.2 0, 0.4 0.4 0, 0.6 0.2 0, 0.4 0 0, 0.2 0.2 0)),"
+            "POLYGON Z((5 5 0, 5 6 0, 6 6 0, 5 5 0)),"
+            "CURVEPOLYGON Z(CIRCULARSTRING Z(10 10 0, 11 11 3, 12 10 0, 11 9 0, 10 10 0)))"
+        )
+
+        snap_points = get_snap_points(1, geometry)
+        self.assertEqual(len(snap_points), 6)
+        for snap_point in snap_points:
+            vertex = geometry.vertexAt(snap_point.vertex_nr)
+            self.assertEqual(snap_point.mid, (vertex.x(), vertex.y()))
+            self.assertEqual(snap_point.z, vertex.z())
+
+            v_a, v_c = geometry.adjacentVertices(snap_point.vertex_nr)
+            start, end = geometry.vertexAt(v_a), geometry.vertexAt(v_c)
+            self.assertEqual(snap_point.start, (start.x(), start.y()))
+            self.assertEqual(snap_point.end, (end.x(), end.y()))
+
+            radius, center_x, center_y = QgsGeometryUtils.circleCenterRadius(
+                start, vertex, end
+            )
+            self.assertAlmostEqual(snap_point.radius, radius)
+            self.assertAlmostEqual(snap_point.center[0], center_x)
+            self.assertAlmostEqual(snap_point.center[1], center_y)
+
+    def test_layers_watched_lazily(self):
+        plugin = plugins["autocurve"]
+        plugin.auto_curve_action.setChecked(False)
+        plugin.harmonize_arcs_action.setChecked(False)
+
+        vl = self._make_layer([])
+        iface.setActiveLayer(vl)
+
+        # Nothing is followed while the plugin is idle
+        self.assertFalse(plugin.watching)
+        self.assertEqual(plugin.watched_layers, {})
+
+        # Layers are only watched once edited
+        plugin.harmonize_arcs_action.setChecked(True)
+        self.assertIn(vl, plugin.armed_layers)
+        self.assertNotIn(vl, plugin.watched_layers)
+        vl.startEditing()
+        self.assertIn(vl, plugin.watched_layers)
+        vl.rollBack()
+        self.assertNotIn(vl, plugin.watched_layers)
+
+        # Layers without arcs to post-process are not even armed
+        points = self._make_layer([], geom_type="point")
+        self.assertNotIn(points, plugin.armed_layers)
+        lines = self._make_layer([], geom_type="linestring")
+        self.assertIn(lines, plugin.armed_layers)
+        lines.startEditing()
+        self.assertNotIn(lines, plugin.watched_layers)
+
+        # Until the enabled actions apply to them
+        plugin.auto_curve_action.setChecked(True)
+        self.assertIn(lines, plugin.watched_layers)
+        plugin.auto_curve_action.setChecked(False)
+        self.assertNotIn(lines, plugin.watched_layers)
+        lines.rollBack()
+
+        plugin.harmonize_arcs_action.setChecked(False)
+        self.assertEqual(plugin.armed_layers, {})
+        self.assertEqual(plugin.watched_layers, {})
+
+    def test_auto_tolerances(self):
+        swiss = QgsCoordinateReferenceSystem("EPSG:2056")
+        extent = QgsRectangle(2600000, 1200000, 2601000, 1201000)
+        tolerances = settings.auto_tolerances(extent, swiss)
+        self.assertAlmostEqual(tolerances.distance, 1e-3)
+        self.assertAlmostEqual(tolerances.angle, math.degrees(1e-3))
+
+        # Tolerances follow the units of the CRS
+        wgs84 = QgsCoordinateReferenceSystem("EPSG:4326")
+        tolerances = settings.auto_tolerances(QgsRectangle(7, 46, 8, 47), wgs84)
+        self.assertLess(tolerances.distance, 1e-7)
+        self.assertAlmostEqual(tolerances.angle, math.degrees(1e-3))
+
+        # And the magnitude of coordinates and the precision of the layer
+        huge = QgsRectangle(-1e12, -1e12, 1e12, 1e12)
+        self.assertAlmostEqual(settings.auto_tolerances(huge, swiss).distance, 1)
+        tolerances = settings.auto_tolerances(extent, swiss, precision=0.01)
+        self.assertAlmostEqual(tolerances.distance, 0.005)
+
+        # Tolerances of layers are cached until settings are invalidated
+        vl = self._make_layer([])
+        QgsSettings().setValue(settings.AUTO_TOLERANCES_KEY, "true")
+        try:
+            self.assertAlmostEqual(settings.layer_tolerances(vl).distance, 1e-3)
+            vl.geometryOptions().setGeometryPrecision(0.01)
+            self.assertAlmostEqual(settings.layer_tolerances(vl).distance, 1e-3)
+            settings.invalidate()
+            self.assertAlmostEqual(settings.layer_tolerances(vl).distance, 0.005)
+        finally:
+            QgsSettings().remove(settings.AUTO_TOLERANCES_KEY)
+            settings.invalidate()
+        self.assertEqual(settings.layer_tolerances(vl), settings.tolerances())
+
     def test_autocurve_basic(self):
         # Disable the actions
         plugins["autocurve"].auto_curve_action.setChecked(False)
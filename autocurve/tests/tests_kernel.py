@@ -0,0 +1,217 @@
+"""
+Unit tests of the geometry kernel, which don't need QGIS.
+
+    python3 -m unittest autocurve.tests.tests_kernel
+"""
+
+import math
+import struct
+import unittest
+
+from autocurve.kernel import (
+    MiniIndex,
+    SnapCurvePoint,
+    cached_circle_center_radius,
+    circle_center_radius,
+    match_arcs,
+    snap_points_from_wkb,
+)
+
+
+def _wkb(wkb_type, *parts, endian="<"):
+    """Builds a WKB geometry from its type and raw parts (already packed bytes)"""
+    byte_order = b"\x01" if endian == "<" else b"\x00"
+    return byte_order + struct.pack(f"{endian}I", wkb_type) + b"".join(parts)
+
+
+def _points(points, endian="<"):
+    values = [value for point in points for value in point]
+    return struct.pack(f"{endian}I{len(values)}d", len(points), *values)
+
+
+def _collection(wkb_type, *geometries, endian="<"):
+    count = struct.pack(f"{endian}I", len(geometries))
+    return _wkb(wkb_type, count, *geometries, endian=endian)
+
+
+class KernelTest(unittest.TestCase):
+    def test_circle_center_radius(self):
+        radius, center = circle_center_radius((0, 1), (1, 0), (0, -1))
+        self.assertAlmostEqual(radius, 1)
+        self.assertAlmostEqual(center[0], 0)
+        self.assertAlmostEqual(center[1], 0)
+
+        # Closed circles have the first two points as diameter
+        radius, center = circle_center_radius((0, 0), (2, 0), (0, 0))
+        self.assertAlmostEqual(radius, 1)
+        self.assertEqual(center, (1, 0))
+
+        # Collinear points have no circle
+        self.assertEqual(circle_center_radius((0, 0), (1, 1), (2, 2)), (-1, (0, 0)))
+
+    def test_circles_are_memoized(self):
+        hits = cached_circle_center_radius.cache_info().hits
+        arc_1 = SnapCurvePoint(1, 1, (10, 11), (11, 10), (10, 9))
+        # The same arc read again, e.g. after another vertex of its feature changed
+        arc_2 = SnapCurvePoint(1, 1, (10, 11), (11, 10), (10, 9))
+        self.assertEqual(cached_circle_center_radius.cache_info().hits, hits + 1)
+        self.assertEqual(arc_2.center, arc_1.center)
+        self.assertEqual(arc_2.radius, arc_1.radius)
+
+    def test_snap_points_from_wkb(self):
+        # CURVEPOLYGON(COMPOUNDCURVE((0 0, 0 1), CIRCULARSTRING(0 1, 0.5 1.5, 1 1), (1 1, 0 0)))
+        geometry = _collection(
+            10,
+            _collection(
+                9,
+                _wkb(2, _points([(0, 0), (0, 1)])),
+                _wkb(8, _points([(0, 1), (0.5, 1.5), (1, 1)])),
+                _wkb(2, _points([(1, 1), (0, 0)])),
+            ),
+        )
+
+        (snap_point,) = snap_points_from_wkb(7, geometry, "layer")
+        self.assertEqual(snap_point.fid, 7)
+        self.assertEqual(snap_point.layer_id, "layer")
+        # Vertices shared by the parts of the compound curve are counted once
+        self.assertEqual(snap_point.vertex_nr, 2)
+        self.assertEqual(snap_point.start, (0, 1))
+        self.assertEqual(snap_point.mid, (0.5, 1.5))
+        self.assertEqual(snap_point.end, (1, 1))
+        self.assertTrue(math.isnan(snap_point.z))
+        self.assertAlmostEqual(snap_point.radius, 0.5)
+
+    def test_snap_points_from_wkb_dimensions(self):
+        # ISO CIRCULARSTRING Z with two arcs, in big endian
+        iso = _wkb(
+            1008,
+            _points([(0, 0, 1), (1, 1, 2), (2, 0, 3), (3, -1, 4), (4, 0, 5)], ">"),
+            endian=">",
+        )
+        # EWKB CIRCULARSTRING M with an SRID
+        ewkb = _wkb(
+            8 | 0x40000000 | 0x20000000,
+            struct.pack("<I", 2056),
+            _points([(0, 0, 1), (1, 1, 2), (2, 0, 3)]),
+        )
+        # MULTISURFACE of a polygon (without arcs) and a curve polygon
+        multi = _collection(
+            12,
+            _wkb(3, struct.pack("<I", 1), _points([(5, 5), (5, 6), (6, 5), (5, 5)])),
+            _collection(
+                10, _wkb(8, _points([(0, 0), (1, 1), (2, 0), (1, -1), (0, 0)]))
+            ),
+        )
+
+        snap_points = snap_points_from_wkb(1, iso)
+        self.assertEqual([sp.vertex_nr for sp in snap_points], [1, 3])
+        self.assertEqual([sp.z for sp in snap_points], [2, 4])
+        self.assertTrue(all(math.isnan(sp.m) for sp in snap_points))
+
+        (snap_point,) = snap_points_from_wkb(1, ewkb)
+        self.assertEqual(snap_point.mid, (1, 1))
+        self.assertTrue(math.isnan(snap_point.z))
+        self.assertEqual(snap_point.m, 2)
+
+        # Vertex numbers continue across parts
+        snap_points = snap_points_from_wkb(1, multi)
+        self.assertEqual([sp.vertex_nr for sp in snap_points], [5, 7])
+
+        with self.assertRaises(ValueError):
+            snap_points_from_wkb(1, _wkb(15, struct.pack("<I", 0)))
+
+    def test_match_arcs(self):
+        arc_1 = SnapCurvePoint(1, 1, (0, 0), (1, 1.01), (2, 0))
+        arc_2 = SnapCurvePoint(2, 3, (2, 0), (1, 0.99), (0, 0))
+        arc_3 = SnapCurvePoint(3, 1, (0, 0), (1, 0.5), (2, 0))
+        other_layer = SnapCurvePoint(1, 5, (0, 0), (1, 1), (2, 0), layer_id="other")
+
+        index = MiniIndex(tolerance=0.1)
+        index.add_snap_points([arc_1, arc_2, arc_3])
+        snap_points = [arc_1, arc_2, arc_3]
+        neighbours = index.get_neighbours_bulk(snap_points)
+
+        # Only the lower id snaps to the higher one, arcs of other circles don't snap
+        moves = match_arcs(snap_points, neighbours, tolerance=0.1)
+        self.assertEqual([move[:5] for move in moves], [(1, 1, 2, 1, 0.99)])
+
+        # Unless the higher one isn't harmonized
+        moves = match_arcs(snap_points[1:], neighbours[1:], 0.1, fids={2, 3})
+        self.assertEqual([move[:3] for move in moves], [(2, 3, 1)])
+        moves = match_arcs(snap_points[:1], neighbours[:1], 0.1, fids={1})
+        self.assertEqual([move[:3] for move in moves], [(1, 1, 2)])
+
+        # Arcs of other layers are always snapped to, even with the same fid
+        index.add_snap_point(other_layer)
+        moves = match_arcs([arc_1], index.get_neighbours_bulk([arc_1]), 0.1)
+        self.assertEqual([move[:3] for move in moves], [(1, 1, 2), (1, 1, 1)])
+
+    def test_index_cell_boundaries(self):
+        # Two equivalent arcs, with endpoints on both sides of a cell boundary
+        arc_1 = SnapCurvePoint(1, 1, (0.0999, 0), (0.5, 0.4), (0.9999, 0))
+        arc_2 = SnapCurvePoint(2, 1, (1.0001, 0), (0.5, 0.4), (0.1001, 0))
+
+        index = MiniIndex(tolerance=0.1, origin=(0, 0))
+        index.add_snap_points([arc_2])
+        self.assertEqual(index.get_neighbours(arc_1), [arc_2])
+
+        # Also with large coordinates
+        offset = 2600000
+        arc_3 = SnapCurvePoint(
+            3,
+            1,
+            (offset + 0.0999, offset),
+            (offset + 0.5, offset + 0.4),
+            (offset + 0.9999, offset),
+        )
+        arc_4 = SnapCurvePoint(
+            4,
+            1,
+            (offset + 0.1001, offset),
+            (offset + 0.5, offset + 0.4),
+            (offset + 1.0001, offset),
+        )
+
+        index = MiniIndex(tolerance=0.1)
+        index.add_snap_points([arc_4])
+        self.assertEqual(index.get_neighbours(arc_3), [arc_4])
+
+        index.remove_snap_point(arc_4)
+        self.assertEqual(index.get_neighbours(arc_3), [])
+
+    def test_index_origin(self):
+        offset = 2600000
+        # A straight arc, which has no circle and thus a (0, 0) center
+        straight = SnapCurvePoint(
+            1, 1, (offset, offset), (offset + 1, offset + 1), (offset + 2, offset + 2)
+        )
+        self.assertEqual(straight.center, (0, 0))
+        arc_1 = SnapCurvePoint(
+            2, 1, (offset, offset), (offset + 1, offset + 1), (offset + 2, offset)
+        )
+        arc_2 = SnapCurvePoint(
+            3, 1, (offset + 2, offset), (offset + 1, offset + 0.99), (offset, offset)
+        )
+
+        # The origin is the first indexed endpoint, even if the first arc is straight
+        index = MiniIndex(tolerance=0.1)
+        index.add_snap_points([straight, arc_2])
+        self.assertEqual(index.origin, straight.start)
+        self.assertEqual(index.get_neighbours(arc_1), [arc_2])
+
+    def test_index_filters_centers(self):
+        # Consecutive arcs of a circle share an endpoint and their center
+        arc_1 = SnapCurvePoint(1, 1, (1, 0), (0, 1), (-1, 0))
+        arc_2 = SnapCurvePoint(1, 3, (-1, 0), (0, -1), (1, 0))
+        # Arcs of another circle sharing both endpoints
+        arc_3 = SnapCurvePoint(2, 1, (1, 0), (0, 0.5), (-1, 0))
+        # An equivalent arc, with its center just across a cell boundary
+        arc_4 = SnapCurvePoint(3, 1, (1, 0), (0, 0.95), (-1, 0))
+
+        index = MiniIndex(tolerance=0.1, origin=(0, 0))
+        index.add_snap_points([arc_2, arc_3, arc_4])
+        self.assertEqual(index.get_neighbours(arc_1), [arc_2, arc_4])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,92 +1,273 @@
-from collections import defaultdict
-from dataclasses import dataclass
-from typing import Dict, List, Tuple
+import math
+from collections import OrderedDict
+from typing import Collection, Dict, List, Optional, Protocol, Set, Tuple
 
-from qgis.core import QgsFeature, QgsGeometryUtils, QgsPoint
+from qgis.core import QgsGeometry, QgsPoint, QgsRectangle, QgsWkbTypes
 
-from . import settings
+from . import kernel
+from .kernel import MiniIndex, Move, SnapCurvePoint, snap_points_from_wkb
+from .profiling import profiler
 
+# Number of extents whose arcs are known to be indexed, per layer
+MAX_COVERED_EXTENTS = 64
 
-def _almost_equal(p1, p2):
-    """Test point equality with tolerance"""
-    return p1.distance(p2) <= settings.distance()
 
+class Feedback(Protocol):
+    """Progress and cancellation of a long running step, like QgsFeedback"""
 
-@dataclass
-class SnapCurvePoint:
-    """Helper class to represents a curve point on which we can snap."""
+    def isCanceled(self) -> bool:
+        ...
 
-    feature: QgsFeature
-    vertex_nr: int
-    vertex: QgsPoint
+    def setProgress(self, progress: float) -> None:
+        ...
 
-    @property
-    def arc_nrs(self):
-        # Get the 3 points indices that form the arcs
-        v_b = self.vertex_nr
-        v_a, v_c = self.feature.geometry().adjacentVertices(v_b)
-        return (v_a, v_b, v_c)
 
-    @property
-    def arc_points(self):
-        # Get the 3 QgsPoints that form the arcs
-        v_a, v_b, v_c = self.arc_nrs
-        return (
-            self.feature.geometry().vertexAt(v_a),
-            self.feature.geometry().vertexAt(v_b),
-            self.feature.geometry().vertexAt(v_c),
-        )
+def has_curves(geometry: QgsGeometry) -> bool:
+    """Returns whether the geometry has any arc, without walking its vertices"""
 
-    def snaps_to(self, other: "SnapCurvePoint"):
-        # Dont snap the feature against itself
-        if self.feature.id() == other.feature.id():
-            return False
+    abstract_geometry = geometry.constGet()
+    return (
+        abstract_geometry is not None
+        and QgsWkbTypes.isCurvedType(abstract_geometry.wkbType())
+        and abstract_geometry.hasCurvedSegments()
+    )
 
-        p1a, p1b, p1c = self.arc_points
-        p2a, p2b, p2c = other.arc_points
 
-        # Test if start and end points are equal
-        if not (_almost_equal(p1a, p2a) and _almost_equal(p1c, p2c)) and not (
-            _almost_equal(p1a, p2c) and _almost_equal(p1c, p2a)
-        ):
-            return False
+def get_snap_points(
+    fid: int, geometry: QgsGeometry, layer_id: Optional[str] = None
+) -> List[SnapCurvePoint]:
+    """Returns a list of snap points for the given feature geometry"""
 
-        # Test if circles are equivalent (same center point within tolerance)
-        _, c1x, c1y = QgsGeometryUtils.circleCenterRadius(p1a, p1b, p1c)
-        _, c2x, c2y = QgsGeometryUtils.circleCenterRadius(p2a, p2b, p2c)
-        if not _almost_equal(QgsPoint(c1x, c1y), QgsPoint(c2x, c2y)):
-            return False
+    # Most features are straight only, which is found out without reading vertices
+    if not has_curves(geometry):
+        return []
+    return snap_points_from_wkb(fid, bytes(geometry.asWkb()), layer_id)
 
-        return True
 
+class SnapPointsCache:
+    """LRU cache of the snap points of features, to be invalidated when they change"""
 
-class MiniIndex:
-    """Specialized index that indexes arcs by start/endpoint for fast retrieval"""
+    def __init__(self, max_size: int, layer_id: Optional[str] = None):
+        self.max_size = max_size
+        self.layer_id = layer_id
+        self.snap_points: Dict[int, List[SnapCurvePoint]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, fid: int, geometry: QgsGeometry) -> List[SnapCurvePoint]:
+        """Returns the snap points of the feature, only extracting them if not cached"""
+
+        snap_points = self.snap_points.get(fid)
+        if snap_points is None:
+            self.misses += 1
+            snap_points = get_snap_points(fid, geometry, self.layer_id)
+            self.snap_points[fid] = snap_points
+            if len(self.snap_points) > self.max_size:
+                self.snap_points.popitem(last=False)
+        else:
+            self.hits += 1
+            self.snap_points.move_to_end(fid)
+        return snap_points
+
+    def invalidate(self, fid: int):
+        self.snap_points.pop(fid, None)
+
+    def __contains__(self, fid: int) -> bool:
+        return fid in self.snap_points
+
+
+def match_arcs(
+    snap_points: List[SnapCurvePoint],
+    index: MiniIndex,
+    tolerance: float,
+    fids: Optional[Collection[int]] = None,
+) -> List[Move]:
+    """Returns the moves that snap the given arcs centers onto equivalent neighbours
+    of the index, see kernel.match_arcs"""
+
+    neighbours = index.get_neighbours_bulk(snap_points)
+    if profiler.active:
+        profiler.count("candidates", sum(len(candidates) for candidates in neighbours))
+    return kernel.match_arcs(snap_points, neighbours, tolerance, fids)
 
-    def __init__(self, tolerance):
-        self.tolerance = tolerance
-        self.index: Dict[Tuple[int, int, int, int], List[SnapCurvePoint]] = defaultdict(
-            list
-        )
 
-    def _make_key(self, snap_point: SnapCurvePoint):
-        p_a, _, p_c = snap_point.arc_points
+def apply_moves(
+    geometries: Dict[int, QgsGeometry], moves: List[Move]
+) -> Dict[int, QgsGeometry]:
+    """Applies the moves on a single copy of each moved geometry.
 
-        # Sort the start/endpoint so index ignores segment direction
-        if (p_c.x(), p_c.y()) < (p_a.x(), p_a.y()):
-            p_a, p_c = p_c, p_a
+    Moves are applied in sorted order so that the result doesn't depend on the order
+    in which they were computed.
+    """
 
-        return (
-            int(p_a.x() // self.tolerance),
-            int(p_a.y() // self.tolerance),
-            int(p_c.x() // self.tolerance),
-            int(p_c.y() // self.tolerance),
+    new_geoms: Dict[int, QgsGeometry] = {}
+    for fid, vertex_nr, _, x, y, z, m in sorted(moves):
+        new_geom = new_geoms.get(fid)
+        if new_geom is None:
+            new_geom = QgsGeometry(geometries[fid])
+            new_geoms[fid] = new_geom
+        success = new_geom.moveVertex(QgsPoint(x, y, z, m), vertex_nr)
+        assert success
+    return new_geoms
+
+
+class LayerArcIndex(MiniIndex):
+    """MiniIndex holding the arcs of whole layers, meant to be kept up to date as features change.
+
+    Features are identified by their layer id and feature id, so that arcs of several
+    layers can be matched in a single pass. The index may only hold some regions of
+    the layers, whose extents are tracked per layer.
+    """
+
+    def __init__(self, tolerance, layer_ids: Collection[str] = ()):
+        super().__init__(tolerance)
+        self.layer_ids = frozenset(layer_ids)
+        self.snap_points_by_fid: Dict[
+            Tuple[Optional[str], int], List[SnapCurvePoint]
+        ] = {}
+        self.covered_extents: Dict[Optional[str], List[QgsRectangle]] = {}
+        self.indexed_fids: Set[Tuple[Optional[str], int]] = set()
+
+    def covers(self, extent: QgsRectangle, layer_id: Optional[str] = None) -> bool:
+        """Returns whether all arcs of the layer within the extent are indexed"""
+        # Most recent first, as edits tend to happen in the same area
+        return any(
+            covered.contains(extent)
+            for covered in reversed(self.covered_extents.get(layer_id, []))
         )
 
-    def add_snap_point(self, snap_point: SnapCurvePoint):
-        key = self._make_key(snap_point)
-        self.index[key].append(snap_point)
+    def add_covered_extent(self, extent: QgsRectangle, layer_id: Optional[str] = None):
+        # Extents within the new one are redundant, and only the last ones are kept:
+        # forgetting an extent only means reading it again, its arcs stay indexed
+        extents = [
+            covered
+            for covered in self.covered_extents.get(layer_id, [])
+            if not extent.contains(covered)
+        ]
+        extents.append(QgsRectangle(extent))
+        self.covered_extents[layer_id] = extents[-MAX_COVERED_EXTENTS:]
+
+    def has_feature(self, fid: int, layer_id: Optional[str] = None) -> bool:
+        return (layer_id, fid) in self.indexed_fids
+
+    def set_snap_points(
+        self,
+        fid: int,
+        snap_points: List[SnapCurvePoint],
+        layer_id: Optional[str] = None,
+    ):
+        """Replaces the indexed snap points of the given feature"""
+        self.remove_feature(fid, layer_id)
+        self.indexed_fids.add((layer_id, fid))
+        if snap_points:
+            self.snap_points_by_fid[(layer_id, fid)] = snap_points
+            self.add_snap_points(snap_points)
+
+    def remove_feature(self, fid: int, layer_id: Optional[str] = None):
+        """Removes all indexed snap points of the given feature"""
+        self.indexed_fids.discard((layer_id, fid))
+        for snap_point in self.snap_points_by_fid.pop((layer_id, fid), []):
+            self.remove_snap_point(snap_point)
+
+    def copy_region(
+        self,
+        extent: QgsRectangle,
+        excluded: Collection[Tuple[Optional[str], int]] = (),
+    ) -> MiniIndex:
+        """Returns a standalone index of the arcs having an endpoint within the extent,
+        except the ones of the excluded (layer id, fid) features.
+
+        Unlike this index, the copy doesn't change as edits happen, so it can be used
+        from another thread.
+        """
+
+        x_min, x_max = extent.xMinimum(), extent.xMaximum()
+        y_min, y_max = extent.yMinimum(), extent.yMaximum()
+        excluded = set(excluded)
+
+        copy = MiniIndex(self.tolerance, self.origin)
+        for key, snap_points in self.snap_points_by_fid.items():
+            if key in excluded:
+                continue
+            for snap_point in snap_points:
+                if any(
+                    x_min <= x <= x_max and y_min <= y <= y_max
+                    for x, y in (snap_point.start, snap_point.end)
+                ):
+                    copy.add_snap_point(snap_point)
+        return copy
+
+    def remove_uncommitted_features(self, layer_id: Optional[str] = None):
+        """Removes features with temporary (negative) ids, which become invalid after a commit"""
+        uncommitted = [
+            fid
+            for feature_layer_id, fid in self.indexed_fids
+            if feature_layer_id == layer_id and fid < 0
+        ]
+        for fid in uncommitted:
+            self.remove_feature(fid, layer_id)
+
+
+def curvify_geometries(
+    geometries: Dict[int, QgsGeometry],
+    distance: float,
+    angle: float,
+    feedback: Optional[Feedback] = None,
+) -> Dict[int, QgsGeometry]:
+    """Converts the given geometries to curves, returning only the ones that changed.
+
+    The angle tolerance is in degrees, like for the convert to curves algorithm of
+    processing.
+    """
+
+    new_geoms: Dict[int, QgsGeometry] = {}
+    for i, (fid, geometry) in enumerate(geometries.items()):
+        if feedback is not None:
+            if feedback.isCanceled():
+                break
+            feedback.setProgress(100 * i / len(geometries))
+
+        new_geom = geometry.convertToCurves(distance, math.radians(angle))
+        if new_geom.isNull() or new_geom.asWkb() == geometry.asWkb():
+            continue
+        new_geoms[fid] = new_geom
+
+    return new_geoms
+
+
+def harmonize_geometries(
+    geometries: Dict[int, QgsGeometry],
+    index: MiniIndex,
+    feedback: Optional[Feedback] = None,
+    cache: Optional[SnapPointsCache] = None,
+    layer_id: Optional[str] = None,
+) -> Dict[int, QgsGeometry]:
+    """Snaps arc centers of the given geometries to neighbouring arc centers of the
+    index, returning only the geometries that changed.
+
+    If a cache is given, it must be up to date with the given geometries and be the
+    one of their layer. The layer id must be given if the index holds several layers.
+    """
+
+    # Find all arcs points of the geometries
+    snap_points = []
+    with profiler.stage("snap_points"):
+        for i, (fid, geometry) in enumerate(geometries.items()):
+            if feedback is not None:
+                if feedback.isCanceled():
+                    return {}
+                feedback.setProgress(100 * i / len(geometries))
+
+            if cache is not None:
+                snap_points.extend(cache.get(fid, geometry))
+            else:
+                snap_points.extend(get_snap_points(fid, geometry, layer_id))
+    profiler.count("arcs", len(snap_points))
+
+    # Match them all at once against neighbouring arcs
+    with profiler.stage("match"):
+        moves = match_arcs(snap_points, index, index.tolerance)
+    profiler.count("matches", len(moves))
 
-    def get_neighbours(self, snap_point: SnapCurvePoint) -> List[SnapCurvePoint]:
-        key = self._make_key(snap_point)
-        return self.index[key]
+    with profiler.stage("move"):
+        return apply_moves(geometries, moves)